@@ -0,0 +1,215 @@
+#!/usr/bin/python
+#
+# asyncio reflow controller
+# Runs any number of ReflowStateMachine instances as tasks of one event loop.
+# Each oven gets a sensor task, reading the thermocouple through an executor so that
+# blocking sysfs/I2C calls never stall the loop, and a control task woken on the
+# state machine's deadlines (PID steps, relay window edges and display refreshes).
+#
+import argparse
+import asyncio
+import heapq
+import itertools
+from reflowctl import ReflowStateMachine, ReflowState
+from thermocouple import *
+from relayinterface import *
+from clock import GetDefaultClock, VirtualClock
+from gains import LoadGainTable
+
+
+class AsyncTimer(object):
+    """ Deadline sleeps on a clock.Clock for the tasks of one event loop.
+    On a VirtualClock, time only moves once every spawned task is asleep, straight to the earliest deadline,
+    so that simulated ovens keep the same deterministic timing as the blocking loop.
+    """
+    def __init__(self, clock = None):
+        if (clock is None):
+            clock = GetDefaultClock()
+        self.__clock = clock
+        self.__virtual = isinstance(clock, VirtualClock)
+        self.__tasks = set()
+        self.__sleepers = list()
+        self.__sequence = itertools.count()
+        self.__wake = None
+
+    def GetClock(self):
+        return self.__clock
+
+    def Spawn(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self.__tasks.add(task)
+        task.add_done_callback(self.__OnTaskDone)
+        return task
+
+    async def SleepUntil(self, deadline):
+        if not self.__virtual:
+            await asyncio.sleep(max(0.0, deadline - self.__clock.Now()))
+            return
+        if (deadline <= self.__clock.Now()):
+            await asyncio.sleep(0)
+            return
+        entry = [deadline, next(self.__sequence), asyncio.get_running_loop().create_future()]
+        heapq.heappush(self.__sleepers, entry)
+        self.__Wake()
+        try:
+            await entry[2]
+        except asyncio.CancelledError:
+            if entry in self.__sleepers:
+                self.__sleepers.remove(entry)
+                heapq.heapify(self.__sleepers)
+            raise
+
+    async def Run(self):
+        """ Returns once every spawned task is done. """
+        if not self.__virtual:
+            while len(self.__tasks) > 0:
+                await asyncio.wait(list(self.__tasks))
+            return
+        self.__wake = asyncio.Event()
+        while len(self.__tasks) > 0:
+            await self.__wake.wait()
+            self.__wake.clear()
+            # Tasks blocked in an executor are not asleep yet: wait for them
+            if (len(self.__sleepers) == 0) or (len(self.__sleepers) < len(self.__tasks)):
+                continue
+            deadline = self.__sleepers[0][0]
+            self.__clock.SleepUntil(deadline)
+            while (len(self.__sleepers) > 0) and (self.__sleepers[0][0] <= deadline):
+                heapq.heappop(self.__sleepers)[2].set_result(None)
+
+    def __Wake(self):
+        if (self.__wake is not None):
+            self.__wake.set()
+
+    def __OnTaskDone(self, task):
+        self.__tasks.discard(task)
+        self.__Wake()
+
+
+class AsyncThermocoupleSampler(object):
+    """ Sensor task publishing timestamped samples, with the GetLatest() interface of ThermocoupleSampler. """
+    def __init__(self, thermocouple, timer, samplingPeriodMs = 1000, executor = None):
+        self.__thermocouple = thermocouple
+        self.__timer = timer
+        self.__clock = timer.GetClock()
+        self.__samplingPeriod = samplingPeriodMs / 1000.0
+        self.__executor = executor
+        self.__latest = None
+        self.__lastError = None
+
+    def GetLatest(self):
+        return self.__latest
+
+    def GetLastError(self):
+        return self.__lastError
+
+    async def Sample(self):
+        try:
+            celsius = await asyncio.get_running_loop().run_in_executor(self.__executor, self.__thermocouple.ReadCelsius)
+        except Exception as e:
+            self.__lastError = e
+            return
+        self.__latest = (self.__clock.Now(), celsius)
+        self.__lastError = None
+
+    async def Run(self, nextRead):
+        while True:
+            await self.__timer.SleepUntil(nextRead)
+            nextRead += self.__samplingPeriod
+            await self.Sample()
+
+
+class AsyncReflowOven(object):
+    def __init__(self, reflowProfile, thermocouple, relay, timer, lcd = None, gainTable = None, recorder = None, bank = None, executor = None):
+        self.__timer = timer
+        self.__relay = relay
+        self.__bank = bank
+        self.__sampler = AsyncThermocoupleSampler(thermocouple, timer, ReflowStateMachine.SENSOR_SAMPLING_TIME, executor)
+        self.__reflowCtl = ReflowStateMachine(reflowProfile, thermocouple, relay, lcd = lcd, sampler = self.__sampler,
+                                              clock = timer.GetClock(), gainTable = gainTable, recorder = recorder)
+
+    def GetStateMachine(self):
+        return self.__reflowCtl
+
+    async def Reflow(self):
+        """ Runs one reflow cycle and returns the final ReflowState. """
+        clock = self.__timer.GetClock()
+        start = clock.Now()
+        # The state machine needs a first sample before its first step
+        await self.__sampler.Sample()
+        sensor = self.__timer.Spawn(self.__sampler.Run(start + (ReflowStateMachine.SENSOR_SAMPLING_TIME / 1000.0)))
+        try:
+            while not self.__Step():
+                await self.__timer.SleepUntil(self.__reflowCtl.NextDeadline())
+        finally:
+            sensor.cancel()
+            self.__relay.SwitchRelay(RelayInterface.OFF)
+            if (self.__bank is not None):
+                self.__bank.Flush()
+        return self.__reflowCtl.GetState()
+
+    def __Step(self):
+        complete = self.__reflowCtl.Step()
+        if (self.__bank is not None):
+            self.__bank.Flush()
+        return complete
+
+
+async def RunOvens(ovens, timer):
+    """ Runs the reflow cycle of every oven concurrently and returns their final states. """
+    tasks = [timer.Spawn(oven.Reflow()) for oven in ovens]
+    await timer.Run()
+    return [task.result() for task in tasks]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="asyncio Reflow Controller", usage='%(prog)s [options] [parameter]')
+    parser.add_argument('--profile', nargs=1, type=str, required=True, help='built-in reflow profile name or profile file')
+    parser.add_argument('--therm', nargs=1, type=str, required=True, help='thermocouple type to be used')
+    parser.add_argument('--interface', nargs=1, type=str, required=True, help='interface to the relays driving the reflow ovens')
+    parser.add_argument('--pins', nargs='+', type=int, required=True, help='Pin # of each oven relay')
+    parser.add_argument('--aliases', nargs='*', type=str, help='1-Wire alias of each oven thermocouple, in pin order')
+    parser.add_argument('--gains', nargs='*', type=str, help='per-oven PID gain tables, in pin order')
+    parser.add_argument('--i2cbus', nargs=1, type=int, default=[1], help='Relay interface I2C bus #')
+    parser.add_argument('--i2caddr', nargs=1, type=int, default=[0x20], help='Relay interface I2C address (decimal)')
+    parser.add_argument('--virtualclock', nargs='*', help='run on virtual time, as fast as possible (simulated backends only)')
+    args = vars(parser.parse_args())
+
+    _clock = GetDefaultClock()
+    if args['virtualclock'] is not None:
+        _clock = VirtualClock()
+    _bank = None
+    if args['interface'][0] == 'MCP23008BankRelay':
+        from multioven import OpenRelayBank
+        _bank = OpenRelayBank(args['i2cbus'][0], args['i2caddr'][0])
+    timer = AsyncTimer(_clock)
+    tcf = ThermocoupleFactory()
+    rif = RelayInterfaceFactory()
+    relays = list()
+    ovens = list()
+    for index, pin in enumerate(args['pins']):
+        kwargs = {'pin': pin, 'bank': _bank, 'clock': _clock, 'simoven': str(pin),
+                  'i2cbus': args['i2cbus'][0], 'i2caddr': args['i2caddr'][0]}
+        if args['aliases'] is not None:
+            kwargs['alias'] = args['aliases'][index]
+        gainTable = None
+        if args['gains'] is not None:
+            gainTable = LoadGainTable(args['gains'][index])
+        if _bank is not None:
+            relay = MCP23008BankRelay(kwargs)
+        else:
+            relay = rif.GetInstance(args['interface'][0], kwargs)
+        relays.append(relay)
+        ovens.append(AsyncReflowOven(args['profile'][0], tcf.GetInstance(args['therm'][0], kwargs), relay, timer,
+                                     gainTable = gainTable, bank = _bank))
+    try:
+        states = asyncio.run(RunOvens(ovens, timer))
+        for pin, state in zip(args['pins'], states):
+            if state in (ReflowState.REFLOW_STATE_ERROR, ReflowState.REFLOW_STATE_ABORTED):
+                print("Oven on pin " + str(pin) + ": " + ReflowState.Messages[state])
+            else:
+                print("Oven on pin " + str(pin) + ": " + ReflowState.Messages[ReflowState.REFLOW_STATE_COMPLETE])
+    except KeyboardInterrupt:
+        pass
+    for relay in relays:
+        relay.Cleanup()
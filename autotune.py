@@ -0,0 +1,111 @@
+#!/usr/bin/python
+#
+# Relay-feedback PID auto-tuner
+# Astrom-Hagglund relay experiment: the heater is switched fully on below the target
+# and fully off above it, which makes the oven oscillate at its ultimate period Pu.
+# The oscillation amplitude gives the ultimate gain Ku = 4d / (pi * a), from which
+# per-stage PID gains are derived with Ziegler-Nichols style rules.
+#
+import math
+from clock import GetDefaultClock
+from relayinterface import RelayInterface
+from reflowctl import ReflowStateMachine
+from gains import GainTable
+
+
+class RelayAutoTuner(object):
+    # Tuning rules: (Kp, Ki, Kd) as multiples of (Ku, Ku/Pu, Ku*Pu)
+    RULES = {
+        'classic': (0.6, 1.2, 0.075),
+        'someovershoot': (0.33, 0.66, 0.11),
+        'noovershoot': (0.2, 0.4, 0.066),
+    }
+    DEFAULT_RULE = 'someovershoot'
+    HYSTERESIS = 1.0
+    CYCLES = 3
+    TIMEOUT = 3600
+
+    def __init__(self, thermocouple, relay, clock = None, lcd = None, rule = DEFAULT_RULE):
+        if (clock is None):
+            clock = GetDefaultClock()
+        if rule not in self.RULES:
+            raise Exception("Unknown tuning rule: " + rule)
+        self.__thermocouple = thermocouple
+        self.__relay = relay
+        self.__clock = clock
+        self.__lcd = lcd
+        self.__rule = rule
+        self.__samplingPeriod = ReflowStateMachine.SENSOR_SAMPLING_TIME / 1000.0
+        # The PID output spans the whole relay window, the relay swings it between both ends
+        self.__relayAmplitude = ReflowStateMachine.RELAY_WINDOW_SIZE / 2.0
+
+    def Measure(self, setpoint):
+        """ Runs the relay experiment around setpoint and returns (Ku, Pu in seconds). """
+        start = self.__clock.Now()
+        heating = True
+        switchTimes = list()
+        amplitudes = list()
+        high = None
+        low = None
+        nextRead = start
+        try:
+            self.__relay.SwitchRelay(RelayInterface.ON)
+            while len(amplitudes) < (self.CYCLES + 1):
+                self.__clock.SleepUntil(nextRead)
+                nextRead += self.__samplingPeriod
+                now = self.__clock.Now()
+                if (now - start) > self.TIMEOUT:
+                    raise Exception("Auto-tune timed out around " + str(setpoint) + "C")
+                celsius = self.__thermocouple.ReadCelsius()
+                self.__Display(setpoint, celsius, len(amplitudes))
+                if heating:
+                    high = celsius if high is None else max(high, celsius)
+                    if celsius > (setpoint + self.HYSTERESIS):
+                        heating = False
+                        self.__relay.SwitchRelay(RelayInterface.OFF)
+                        low = None
+                else:
+                    low = celsius if low is None else min(low, celsius)
+                    if celsius < (setpoint - self.HYSTERESIS):
+                        heating = True
+                        self.__relay.SwitchRelay(RelayInterface.ON)
+                        # A full period ends on every switch back to heating
+                        if len(switchTimes) > 0:
+                            amplitudes.append((high - low) / 2.0)
+                        switchTimes.append(now)
+                        high = None
+        finally:
+            self.__relay.SwitchRelay(RelayInterface.OFF)
+        # The first period includes the warm up transient: leave it out
+        periods = [b - a for a, b in zip(switchTimes[1:], switchTimes[2:])]
+        Pu = sum(periods) / len(periods)
+        a = sum(amplitudes[1:]) / len(amplitudes[1:])
+        Ku = (4.0 * self.__relayAmplitude) / (math.pi * a)
+        return (Ku, Pu)
+
+    def ComputeGains(self, Ku, Pu):
+        kp, ki, kd = self.RULES[self.__rule]
+        return (kp * Ku, ki * Ku / Pu, kd * Ku * Pu)
+
+    def Tune(self, reflowProfile):
+        """ Measures the oven around the soak and reflow temperatures of a profile.
+        Returns a GainTable, the soak gains are also used for the preheat stage and the reflow gains for cooling.
+        """
+        table = GainTable()
+        soakSetpoint = (reflowProfile.TEMPERATURE_SOAK_MIN + reflowProfile.TEMPERATURE_SOAK_MAX) / 2.0
+        # Keep the oscillation peaks around the profile's peak temperature
+        reflowSetpoint = reflowProfile.TEMPERATURE_REFLOW_MAX - 10.0
+        for stages, setpoint in ((('preheat', 'soak'), soakSetpoint), (('reflow', 'cool'), reflowSetpoint)):
+            Ku, Pu = self.Measure(setpoint)
+            Kp, Ki, Kd = self.ComputeGains(Ku, Pu)
+            for stage in stages:
+                table.SetGains(stage, Kp, Ki, Kd, Ku=Ku, Pu=Pu, setpoint=setpoint, rule=self.__rule)
+        return table
+
+    def __Display(self, setpoint, celsius, cycles):
+        if (self.__lcd is not None):
+            self.__lcd.Clear()
+            self.__lcd.Print("Auto-tune " + str(setpoint) + "C cycle " + str(cycles) + "/" + str(self.CYCLES + 1))
+            self.__lcd.SetCursor(0, 1)
+            self.__lcd.Print(str(celsius) + "C ")
+            self.__lcd.Refresh()
@@ -0,0 +1,198 @@
+#!/usr/bin/python
+#
+# Batch PID simulator
+# Steps N copies of the PID.Compute() math and of the ReflowStateMachine transitions
+# in lock-step over the simulator.OvenModel thermal plant, using NumPy arrays instead
+# of N Python objects, to evaluate thousands of gain sets at once.
+#
+import argparse
+import numpy as np
+from reflowctl import ReflowStateMachine, ReflowState
+from reflowprofile import LoadProfile, SetpointTable
+from simulator import OvenModel
+
+
+class BatchReflowSimulator(object):
+    def __init__(self, reflowProfile, kwargs = None):
+        if kwargs is None:
+            kwargs = dict()
+        self.__profile = reflowProfile
+        self.__ambient = float(kwargs.get('simambient', OvenModel.AMBIENT_TEMPERATURE))
+        self.__power = float(kwargs.get('simpower', OvenModel.HEATER_POWER))
+        self.__loss = float(kwargs.get('simloss', OvenModel.LOSS_COEFFICIENT))
+        self.__mass = float(kwargs.get('simmass', OvenModel.THERMAL_MASS))
+        self.__lag = float(kwargs.get('simlag', OvenModel.SENSOR_LAG))
+        self.__start = float(kwargs.get('simstart', self.__ambient))
+        self.__step = OvenModel.INTEGRATION_STEP
+
+    def Run(self, preheatGains, soakGains, reflowGains, maxTime = 1800.0, coolGains = None):
+        """ Simulates one reflow cycle per candidate.
+        Each *Gains argument is an (N, 3) array of (Kp, Ki, Kd), or a single triplet shared by all candidates.
+        The cooling stage uses the reflow gains unless coolGains is given.
+        Returns a dict of length N arrays: 'peak', 'overshoot', 'soakTime', 'cycleTime' (NaN if the cycle
+        did not complete within maxTime seconds) and 'completed'.
+        """
+        preheatGains = np.atleast_2d(np.asarray(preheatGains, dtype=np.float64))
+        soakGains = np.atleast_2d(np.asarray(soakGains, dtype=np.float64))
+        reflowGains = np.atleast_2d(np.asarray(reflowGains, dtype=np.float64))
+        if coolGains is None:
+            coolGains = reflowGains
+        coolGains = np.atleast_2d(np.asarray(coolGains, dtype=np.float64))
+        count = max(len(preheatGains), len(soakGains), len(reflowGains), len(coolGains))
+        preheatGains = np.broadcast_to(preheatGains, (count, 3))
+        soakGains = np.broadcast_to(soakGains, (count, 3))
+        reflowGains = np.broadcast_to(reflowGains, (count, 3))
+        coolGains = np.broadcast_to(coolGains, (count, 3))
+
+        profile = self.__profile
+        sampleTime = profile.PID_SAMPLE_TIME / 1000.0
+        windowSize = float(ReflowStateMachine.RELAY_WINDOW_SIZE)
+        ticksPerSample = int(round(sampleTime / self.__step))
+        ticksPerWindow = int(round((windowSize / 1000.0) / self.__step))
+
+        # Plant state
+        oven = np.full(count, self.__start)
+        sensor = np.full(count, self.__start)
+        heater = np.zeros(count)
+        # Controller state, as set by the IDLE -> PREHEAT transition
+        state = np.full(count, ReflowState.REFLOW_STATE_PREHEAT, dtype=np.int8)
+        setpoint = np.zeros(count)
+        kp, ki, kd = self.__Tunings(preheatGains, sampleTime)
+        pidInput = sensor.copy()
+        output = np.zeros(count)
+        iTerm = np.zeros(count)
+        lastInput = pidInput.copy()
+        stageStart = np.zeros(count)
+        stageEntry = pidInput.copy()
+        liquidusTime = np.full(count, np.nan)
+        # Metrics
+        peak = sensor.copy()
+        soakTime = np.zeros(count)
+        cycleTime = np.full(count, np.nan)
+
+        PREHEAT = ReflowState.REFLOW_STATE_PREHEAT
+        SOAK = ReflowState.REFLOW_STATE_SOAK
+        REFLOW = ReflowState.REFLOW_STATE_REFLOW
+        COOL = ReflowState.REFLOW_STATE_COOL
+        COMPLETE = ReflowState.REFLOW_STATE_COMPLETE
+
+        maxTicks = int(maxTime / self.__step)
+        for tick in range(maxTicks):
+            if (tick % ticksPerSample) == 0:
+                now = tick * self.__step
+                # Sensor read
+                pidInput = sensor.copy()
+                np.maximum(peak, pidInput, out=peak)
+                soakTime += (state == SOAK) * sampleTime
+
+                # State machine transitions
+                toSoak = (state == PREHEAT) & (pidInput >= profile.TEMPERATURE_SOAK_MIN)
+                self.__SetTunings(toSoak, soakGains, sampleTime, kp, ki, kd)
+                self.__EnterStage(toSoak, SOAK, now, pidInput, state, stageStart, stageEntry)
+
+                toReflow = (state == SOAK) & ~toSoak & (now >= (stageStart + profile.SOAK_TIME))
+                self.__SetTunings(toReflow, reflowGains, sampleTime, kp, ki, kd)
+                self.__EnterStage(toReflow, REFLOW, now, pidInput, state, stageStart, stageEntry)
+                liquidusTime[toReflow] = np.nan
+
+                reflowing = (state == REFLOW) & ~toReflow
+                liquidusTime[reflowing & np.isnan(liquidusTime) & (pidInput >= profile.TEMPERATURE_LIQUIDUS)] = now
+                timeAboveLiquidus = np.where(np.isnan(liquidusTime), 0.0, now - liquidusTime)
+                toCool = (reflowing & (pidInput >= (profile.TEMPERATURE_REFLOW_MAX - profile.TEMPERATURE_PEAK_MARGIN)) &
+                          (timeAboveLiquidus >= profile.TIME_ABOVE_LIQUIDUS))
+                self.__SetTunings(toCool, coolGains, sampleTime, kp, ki, kd)
+                self.__EnterStage(toCool, COOL, now, pidInput, state, stageStart, stageEntry)
+
+                toComplete = (state == COOL) & ~toCool & (pidInput <= profile.TEMPERATURE_COOL_MIN)
+                cycleTime[toComplete] = now
+                state[toComplete] = COMPLETE
+                if np.all(state == COMPLETE):
+                    break
+
+                # Compiled setpoint trajectories
+                for stageState, stage in ReflowStateMachine.STAGES.items():
+                    inStage = (state == stageState)
+                    if np.any(inStage):
+                        setpoint[inStage] = self.__GetSetpoints(profile.GetTable(stage), now - stageStart[inStage], stageEntry[inStage])
+
+                # PID.Compute()
+                error = setpoint - pidInput
+                iTerm += ki * error
+                np.clip(iTerm, 0.0, windowSize, out=iTerm)
+                output = np.clip(kp * error + iTerm - kd * (pidInput - lastInput), 0.0, windowSize)
+                lastInput = pidInput
+
+            # Time proportioning relay, windows start with the preheat stage
+            windowElapsed = (tick % ticksPerWindow) * self.__step * 1000.0
+            heater = ((output > windowElapsed) & (state != COMPLETE)) * self.__power
+
+            # Thermal plant
+            oven += (heater - self.__loss * (oven - self.__ambient)) * self.__step / self.__mass
+            sensor += (oven - sensor) * self.__step / (self.__lag + self.__step)
+
+        results = dict()
+        results['peak'] = peak
+        results['overshoot'] = peak - profile.TEMPERATURE_REFLOW_MAX
+        results['soakTime'] = soakTime
+        results['cycleTime'] = cycleTime
+        results['completed'] = ~np.isnan(cycleTime)
+        return results
+
+    def __EnterStage(self, mask, newState, now, pidInput, state, stageStart, stageEntry):
+        state[mask] = newState
+        stageStart[mask] = now
+        stageEntry[mask] = pidInput[mask]
+
+    def __GetSetpoints(self, table, elapsed, entryTemperature):
+        # Vectorized SetpointTable.GetSetpoint()
+        values = np.frombuffer(table.Values, dtype=np.float64)
+        index = np.minimum((elapsed / table.Resolution + 1e-9).astype(np.int64), len(values) - 1)
+        value = values[index]
+        if table.Kind == SetpointTable.RISE:
+            return np.minimum(entryTemperature + value, table.Target)
+        elif table.Kind == SetpointTable.FALL:
+            return np.maximum(entryTemperature - value, table.Target)
+        return value
+
+    def __Tunings(self, gains, sampleTime):
+        return (gains[:, 0].copy(), gains[:, 1] * sampleTime, gains[:, 2] / sampleTime)
+
+    def __SetTunings(self, mask, gains, sampleTime, kp, ki, kd):
+        _kp, _ki, _kd = self.__Tunings(gains[mask], sampleTime)
+        kp[mask] = _kp
+        ki[mask] = _ki
+        kd[mask] = _kd
+
+
+def ProfileGains(profile):
+    return ((profile.PID_KP_PREHEAT, profile.PID_KI_PREHEAT, profile.PID_KD_PREHEAT),
+            (profile.PID_KP_SOAK, profile.PID_KI_SOAK, profile.PID_KD_SOAK),
+            (profile.PID_KP_REFLOW, profile.PID_KI_REFLOW, profile.PID_KD_REFLOW))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Batch PID gain sweep", usage='%(prog)s [options] [parameter]')
+    parser.add_argument('--profile', nargs=1, type=str, default=['leadfree'], help='reflow profile name or file')
+    parser.add_argument('--candidates', nargs=1, type=int, default=[10000], help='number of random gain sets around the profile gains')
+    parser.add_argument('--spread', nargs=1, type=float, default=[2.0], help='gains are scaled by up to this factor either way')
+    parser.add_argument('--top', nargs=1, type=int, default=[10], help='number of best candidates to print')
+    args = vars(parser.parse_args())
+
+    profile = LoadProfile(args['profile'][0])
+    count = args['candidates'][0]
+    spread = np.log(args['spread'][0])
+    rng = np.random.default_rng()
+    gains = [np.asarray(g) * np.exp(rng.uniform(-spread, spread, (count, 3))) for g in ProfileGains(profile)]
+    # Keep the profile's own gains as candidate 0 for reference
+    for index, g in enumerate(ProfileGains(profile)):
+        gains[index][0] = g
+
+    results = BatchReflowSimulator(profile).Run(gains[0], gains[1], gains[2])
+    # Rank completed cycles by overshoot first, then by cycle time
+    score = np.where(results['completed'], np.abs(results['overshoot']) * 10.0 + results['cycleTime'], np.inf)
+    print("Profile gains: peak %.1fC, cycle %.0fs" % (results['peak'][0], results['cycleTime'][0]))
+    for index in np.argsort(score)[:args['top'][0]]:
+        print("#%d peak %.1fC overshoot %.1fC soak %.0fs cycle %.0fs preheat %s soak %s reflow %s" % (
+            index, results['peak'][index], results['overshoot'][index], results['soakTime'][index],
+            results['cycleTime'][index], np.round(gains[0][index], 3), np.round(gains[1][index], 3),
+            np.round(gains[2][index], 3)))
@@ -0,0 +1,52 @@
+#!/usr/bin/python
+#
+# Time sources for the PID and the reflow state machine.
+# All times are float seconds on a monotonic time base.
+#
+import time
+import threading
+
+
+class Clock(object):
+    def Now(self):
+        raise Exception("Not implemented")
+
+    def SleepUntil(self, deadline):
+        raise Exception("Not implemented")
+
+
+class MonotonicClock(Clock):
+    """ Wall-clock time, immune to system clock adjustments. """
+    def Now(self):
+        return time.monotonic()
+
+    def SleepUntil(self, deadline):
+        delay = deadline - time.monotonic()
+        if (delay > 0.0):
+            time.sleep(delay)
+
+
+class VirtualClock(Clock):
+    """ Simulated time that jumps straight to the next deadline instead of sleeping.
+    Lets a full reflow cycle against a simulated plant run in milliseconds.
+    """
+    def __init__(self, start = 0.0):
+        self.__now = start
+        self.__lock = threading.Lock()
+
+    def Now(self):
+        return self.__now
+
+    def SleepUntil(self, deadline):
+        with self.__lock:
+            if (deadline > self.__now):
+                self.__now = deadline
+
+    def Advance(self, seconds):
+        self.SleepUntil(self.__now + seconds)
+
+
+_defaultClock = MonotonicClock()
+
+def GetDefaultClock():
+    return _defaultClock
@@ -0,0 +1,63 @@
+#!/usr/bin/python
+#
+# Per-oven PID gain tables
+# Written by autotune.py, loaded by ReflowStateMachine at startup to override
+# the gains of the reflow profile files.
+#
+import json
+
+
+class GainTable(object):
+    STAGES = ('preheat', 'soak', 'reflow', 'cool')
+
+    def __init__(self, table = None):
+        self.__table = dict()
+        if table is not None:
+            self.__table.update(table)
+
+    def SetGains(self, stage, Kp, Ki, Kd, **info):
+        if stage not in self.STAGES:
+            raise Exception("Unknown reflow stage: " + stage)
+        entry = dict(info)
+        entry['Kp'] = Kp
+        entry['Ki'] = Ki
+        entry['Kd'] = Kd
+        self.__table[stage] = entry
+
+    def GetGains(self, stage):
+        if stage not in self.__table:
+            return None
+        entry = self.__table[stage]
+        return (entry['Kp'], entry['Ki'], entry['Kd'])
+
+    def GetStages(self):
+        return [stage for stage in self.STAGES if stage in self.__table]
+
+    def Apply(self, reflowProfile):
+        """ Overrides the PID_K*_<STAGE> attributes of a reflow profile instance. """
+        for stage in self.STAGES:
+            gains = self.GetGains(stage)
+            if gains is None and stage == 'cool':
+                # Cooling runs on the reflow gains unless tuned separately
+                gains = self.GetGains('reflow')
+            if gains is None:
+                continue
+            Kp, Ki, Kd = gains
+            suffix = stage.upper()
+            setattr(reflowProfile, 'PID_KP_' + suffix, Kp)
+            setattr(reflowProfile, 'PID_KI_' + suffix, Ki)
+            setattr(reflowProfile, 'PID_KD_' + suffix, Kd)
+        return reflowProfile
+
+    def Save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.__table, f, indent=4, sort_keys=True)
+
+
+def LoadGainTable(filename):
+    """ Returns the GainTable stored in filename, or None when there is no such file. """
+    try:
+        with open(filename, 'r') as f:
+            return GainTable(json.load(f))
+    except IOError:
+        return None
@@ -1,9 +1,9 @@
 #!/usr/bin/python
-import smbus
 
 
 class I2CDevice:
     def __init__(self, I2CBus, I2CDeviceAddress):
+        import smbus
         self.__I2CAddress = I2CDeviceAddress
         self.__I2CBus = smbus.SMBus(I2CBus)
 
@@ -30,3 +30,107 @@ class I2CDevice:
         
     def ReadBytes(self, register, byteCount):
         return self.__I2CBus.read_i2c_block_data(self.__I2CAddress, register, byteCount)
+
+
+class CachedI2CDevice:
+    """ Wraps an I2CDevice and keeps a shadow copy of every register written through it.
+    Writes that would not change a register are dropped. Between Begin() and Commit(), register
+    writes are held back and runs of consecutive registers go out as one block transfer when the
+    device auto-increments its register address (sequential mode).
+    Reads always go to the device, since input registers change on their own.
+    """
+    def __init__(self, i2cDevice, sequential = False):
+        self.__device = i2cDevice
+        self.__sequential = sequential
+        self.__shadow = dict()
+        self.__pending = dict()
+        self.__batchDepth = 0
+        self.Issued = 0
+        self.Suppressed = 0
+
+    def SetSequential(self, sequential):
+        self.__sequential = sequential
+
+    def GetCounters(self):
+        """ Returns the (issued, suppressed) transaction counts. """
+        return (self.Issued, self.Suppressed)
+
+    def Invalidate(self, register = None):
+        if register is None:
+            self.__shadow.clear()
+        else:
+            self.__shadow.pop(register, None)
+
+    def Begin(self):
+        self.__batchDepth += 1
+
+    def Commit(self):
+        self.__batchDepth -= 1
+        if self.__batchDepth > 0:
+            return
+        registers = sorted(self.__pending)
+        index = 0
+        while index < len(registers):
+            start = registers[index]
+            run = [self.__pending[start]]
+            index += 1
+            while (self.__sequential and index < len(registers) and registers[index] == start + len(run)):
+                run.append(self.__pending[registers[index]])
+                index += 1
+            if len(run) == 1:
+                self.__device.WriteRegisterByte(start, run[0])
+            else:
+                self.__device.WriteBytes(start, run)
+            self.Issued += 1
+            for offset in range(len(run)):
+                self.__shadow[start + offset] = run[offset]
+        self.__pending.clear()
+
+    def WriteRegisterByte(self, register, byte):
+        if register in self.__pending:
+            self.__pending[register] = byte
+            return
+        if self.__shadow.get(register) == byte:
+            self.Suppressed += 1
+            return
+        if self.__batchDepth > 0:
+            self.__pending[register] = byte
+            return
+        self.__device.WriteRegisterByte(register, byte)
+        self.__shadow[register] = byte
+        self.Issued += 1
+
+    def ReadRegisterByte(self, register):
+        self.Issued += 1
+        return self.__device.ReadRegisterByte(register)
+
+    def WriteByte(self, byte):
+        self.Issued += 1
+        self.__device.WriteByte(byte)
+
+    def ReadByte(self):
+        self.Issued += 1
+        return self.__device.ReadByte()
+
+    def WriteRegisterWord(self, register, word):
+        self.Invalidate(register)
+        self.Invalidate(register + 1)
+        self.Issued += 1
+        return self.__device.WriteRegisterWord(register, word)
+
+    def ReadRegisterWord(self, register):
+        self.Issued += 1
+        return self.__device.ReadRegisterWord(register)
+
+    def WriteBytes(self, register, dataBytes):
+        self.Issued += 1
+        self.__device.WriteBytes(register, dataBytes)
+        for offset in range(len(dataBytes)):
+            if self.__sequential:
+                self.__shadow[register + offset] = dataBytes[offset]
+            else:
+                self.Invalidate(register + offset)
+
+    def ReadBytes(self, register, byteCount):
+        self.Issued += 1
+        return self.__device.ReadBytes(register, byteCount)
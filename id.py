@@ -18,6 +18,15 @@ class PlatformID(object):
     
     def IsARM(self):
         return self.__IsARM
+
+
+_platformID = None
+
+def GetPlatformID():
+    global _platformID
+    if _platformID is None:
+        _platformID = PlatformID()
+    return _platformID
     
     
 if __name__ == '__main__':
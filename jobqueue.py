@@ -0,0 +1,211 @@
+#!/usr/bin/python
+#
+# Back-to-back reflow job queue
+# Runs queued boards one after the other on the same oven. The next job is armed as soon as
+# the previous cycle completes, so unloading and loading overlap the cooldown, and its cycle
+# starts the moment the oven drops below the profile's start temperature ('startTemperature').
+# Queue wait, cooldown wait, cycle time and oven utilization are tracked per job and overall.
+#
+import argparse
+import threading
+import collections
+from reflowctl import ReflowStateMachine, ReflowState
+from thermocouple import ThermocoupleFactory
+from relayinterface import RelayInterfaceFactory, RelayInterface
+from clock import GetDefaultClock, VirtualClock
+from gains import LoadGainTable
+from reflowprofile import LoadProfile
+
+
+class ReflowJob(object):
+    def __init__(self, number, profile, board, submitted):
+        self.Number = number
+        self.Profile = profile
+        self.Board = board
+        # Clock times: queued, oven free for this job, preheat started, cycle over
+        self.Submitted = submitted
+        self.Armed = None
+        self.Started = None
+        self.Ended = None
+        self.State = None
+
+    def IsCompleted(self):
+        return self.State == ReflowState.REFLOW_STATE_COMPLETE
+
+    def GetQueueWait(self):
+        if self.Started is None:
+            return None
+        return self.Started - self.Submitted
+
+    def GetCooldownWait(self):
+        if self.Started is None:
+            return None
+        return self.Started - self.Armed
+
+    def GetCycleTime(self):
+        if self.Started is None or self.Ended is None:
+            return None
+        return self.Ended - self.Started
+
+
+class ReflowJobQueue(object):
+    def __init__(self, thermocouple, relay, clock = None, gainTable = None, sampler = None, recorder = None, lcd = None):
+        if (clock is None):
+            clock = GetDefaultClock()
+        self.__thermocouple = thermocouple
+        self.__relay = relay
+        self.__clock = clock
+        self.__gainTable = gainTable
+        self.__sampler = sampler
+        self.__recorder = recorder
+        self.__lcd = lcd
+        self.__profiles = dict()
+        self.__pending = collections.deque()
+        self.__done = list()
+        self.__lock = threading.Lock()
+        self.__jobCount = 0
+        self.__reflowCtl = None
+        self.__stopRequested = False
+
+    def Submit(self, profileName, board = None):
+        """ Queues a board and returns its ReflowJob. """
+        profile = self.__GetProfile(profileName)
+        with self.__lock:
+            self.__jobCount += 1
+            job = ReflowJob(self.__jobCount, profile, board or str(self.__jobCount), self.__clock.Now())
+            self.__pending.append(job)
+            return job
+
+    def GetPending(self):
+        with self.__lock:
+            return list(self.__pending)
+
+    def GetDone(self):
+        with self.__lock:
+            return list(self.__done)
+
+    def Stop(self):
+        """ Aborts the running cycle and leaves the remaining jobs queued. """
+        with self.__lock:
+            self.__stopRequested = True
+            if self.__reflowCtl is not None:
+                self.__reflowCtl.Abort()
+
+    def Run(self, onJobDone = None):
+        """ Runs the queued jobs until the queue is empty or Stop() is called, also before Run(). """
+        while True:
+            with self.__lock:
+                if self.__stopRequested:
+                    # Handled: the next Run() goes on with the remaining jobs
+                    self.__stopRequested = False
+                    return
+                if len(self.__pending) == 0:
+                    return
+                job = self.__pending.popleft()
+                self.__reflowCtl = ReflowStateMachine(job.Profile, self.__thermocouple, self.__relay, lcd = self.__lcd,
+                                                      sampler = self.__sampler, clock = self.__clock,
+                                                      recorder = self.__recorder)
+                reflowCtl = self.__reflowCtl
+            job.Armed = self.__clock.Now()
+            try:
+                while not reflowCtl.Step():
+                    if (job.Started is None and reflowCtl.GetState() == ReflowState.REFLOW_STATE_PREHEAT):
+                        job.Started = self.__clock.Now()
+                    self.__clock.SleepUntil(reflowCtl.NextDeadline())
+            except:
+                self.__relay.SwitchRelay(RelayInterface.OFF)
+                raise
+            job.Ended = self.__clock.Now()
+            job.State = reflowCtl.GetState()
+            if job.State == ReflowState.REFLOW_STATE_IDLE:
+                # A completed cycle goes back to idle
+                job.State = ReflowState.REFLOW_STATE_COMPLETE
+            with self.__lock:
+                self.__reflowCtl = None
+                self.__done.append(job)
+            if onJobDone is not None:
+                onJobDone(job)
+
+    def GetMetrics(self):
+        """ Returns the job counts, mean queue wait, cooldown wait and cycle time (seconds),
+        the share of time the oven spent running cycles and the boards per hour, over the jobs done so far.
+        """
+        jobs = self.GetDone()
+        completed = [job for job in jobs if job.IsCompleted()]
+        metrics = {'jobs': len(jobs), 'completed': len(completed), 'failed': len(jobs) - len(completed),
+                   'queueWait': None, 'cooldownWait': None, 'cycleTime': None, 'utilization': None, 'boardsPerHour': None}
+        started = [job for job in jobs if job.Started is not None]
+        if len(started) > 0:
+            metrics['queueWait'] = sum(job.GetQueueWait() for job in started) / len(started)
+            metrics['cooldownWait'] = sum(job.GetCooldownWait() for job in started) / len(started)
+            metrics['cycleTime'] = sum(job.GetCycleTime() for job in started) / len(started)
+        if len(jobs) > 0:
+            # Oven time of each job, from arming to the end of its cycle: idle time between Run() calls is left out
+            span = sum(job.Ended - job.Armed for job in jobs)
+            if span > 0.0:
+                metrics['utilization'] = sum(job.GetCycleTime() for job in started) / span
+                metrics['boardsPerHour'] = len(completed) * 3600.0 / span
+        return metrics
+
+    def __GetProfile(self, name):
+        # Compiled once per queue, with the oven gains applied
+        with self.__lock:
+            profile = self.__profiles.get(name)
+            if profile is None:
+                profile = LoadProfile(name)
+                if (self.__gainTable is not None):
+                    self.__gainTable.Apply(profile)
+                self.__profiles[name] = profile
+            return profile
+
+
+def FormatSeconds(seconds):
+    if seconds is None:
+        return '-'
+    return "%.0fs" % seconds
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Reflow Job Queue", usage='%(prog)s [options] [parameter]')
+    parser.add_argument('--jobs', nargs='+', type=str, required=True, help='boards to reflow in order, as PROFILE or PROFILE:BOARD')
+    parser.add_argument('--therm', nargs=1, type=str, required=True, help='thermocouple type to be used')
+    parser.add_argument('--interface', nargs=1, type=str, required=True, help='interface to the relay driving the reflow oven')
+    parser.add_argument('--pin', nargs=1, type=int, help='Pin # connected to the relay interface')
+    parser.add_argument('--i2cbus', nargs=1, type=int, help='Relay interface I2C bus #')
+    parser.add_argument('--i2caddr', nargs=1, type=int, help='Relay interface I2C address (decimal)')
+    parser.add_argument('--gains', nargs=1, type=str, default=['gains.json'], help='per-oven PID gain table (default: gains.json)')
+    parser.add_argument('--virtualclock', nargs='*', help='run on virtual time, as fast as possible (simulated backends only)')
+    args = vars(parser.parse_args())
+
+    kwargs = dict()
+    for k in args:
+        try:
+            kwargs[k] = args[k][0]
+        except (TypeError, IndexError):
+            pass
+    _clock = GetDefaultClock()
+    if args['virtualclock'] is not None:
+        _clock = VirtualClock()
+        kwargs['clock'] = _clock
+    _relay = RelayInterfaceFactory().GetInstance(args['interface'][0], kwargs)
+    _thermocouple = ThermocoupleFactory().GetInstance(args['therm'][0], kwargs)
+    jobQueue = ReflowJobQueue(_thermocouple, _relay, clock = _clock, gainTable = LoadGainTable(args['gains'][0]))
+    for spec in args['jobs']:
+        profileName, _, board = spec.partition(':')
+        jobQueue.Submit(profileName, board or None)
+
+    def OnJobDone(job):
+        print("Board %s (%s): %s, queue wait %s, cooldown wait %s, cycle %s" % (
+            job.Board, job.Profile.Name, ReflowState.Messages[job.State], FormatSeconds(job.GetQueueWait()),
+            FormatSeconds(job.GetCooldownWait()), FormatSeconds(job.GetCycleTime())))
+
+    try:
+        jobQueue.Run(OnJobDone)
+    except KeyboardInterrupt:
+        _relay.SwitchRelay(RelayInterface.OFF)
+    metrics = jobQueue.GetMetrics()
+    print("%d/%d boards completed, mean queue wait %s, mean cycle %s" % (
+        metrics['completed'], metrics['jobs'], FormatSeconds(metrics['queueWait']), FormatSeconds(metrics['cycleTime'])))
+    if metrics['utilization'] is not None:
+        print("Oven utilization %.1f%%, %.1f boards/hour" % (100.0 * metrics['utilization'], metrics['boardsPerHour']))
+    _relay.Cleanup()
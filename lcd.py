@@ -1,49 +1,167 @@
 #!/usr/bin/python
-import curses
+import sys
+import threading
 
 class LCD(object):
-    def __init__(self):
-        try:
-            self.__stdscr = curses.initscr()
-        except Exception:
-            self.__stdscr = None
-            
+    """ Text display on a curses screen, or on stdout when there is no terminal.
+    Print() only updates a shadow frame buffer. Refresh() writes the cells that differ from what
+    is on screen with a single screen refresh, either right away or from the render thread.
+    Clear() starts a new frame: Print() calls outside of a frame are refreshed immediately.
+    """
+    DEFAULT_LINES = 4
+    DEFAULT_COLUMNS = 40
+
+    def __init__(self, lines = None, columns = None):
+        self.__stdscr = None
+        self.__curses = None
+        # No usable terminal when started from a service or through a pipe
+        if sys.stdin.isatty() and sys.stdout.isatty():
+            import curses
+            self.__curses = curses
+            try:
+                self.__stdscr = curses.initscr()
+                curses.noecho()
+                curses.cbreak()
+                self.__stdscr.keypad(1)
+            except Exception:
+                if (self.__stdscr is not None):
+                    try:
+                        curses.endwin()
+                    except self.__curses.error:
+                        pass
+                self.__stdscr = None
+
         if (self.__stdscr is not None):
-            curses.noecho()
-            curses.cbreak()
-            self.__stdscr.keypad(1)
-        
+            maxLines, maxColumns = self.__stdscr.getmaxyx()
+            lines = min(lines or maxLines, maxLines)
+            columns = min(columns or maxColumns, maxColumns)
+        self.__lines = lines or self.DEFAULT_LINES
+        self.__columns = columns or self.DEFAULT_COLUMNS
+        self.__frame = self.__BlankFrame()
+        self.__screen = [None] * self.__lines
+        self.__pending = None
+        self.__column = 0
+        self.__line = 0
+        self.__inFrame = False
+        self.__lock = threading.Lock()
+        self.__renderEvent = threading.Event()
+        self.__stopEvent = threading.Event()
+        self.__thread = None
+
+    def Start(self):
+        """ Renders from a background thread: Refresh() only hands the frame over. """
+        if self.__thread is not None:
+            return
+        self.__stopEvent.clear()
+        self.__thread = threading.Thread(target = self.__Run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def Stop(self):
+        if self.__thread is None:
+            return
+        self.__stopEvent.set()
+        self.__renderEvent.set()
+        self.__thread.join()
+        self.__thread = None
+
     def Cleanup(self):
+        self.Stop()
         if (self.__stdscr is not None):
             self.__stdscr.keypad(0)
-            curses.nocbreak()
-            curses.echo()
-            curses.endwin()
-    
+            self.__curses.nocbreak()
+            self.__curses.echo()
+            self.__curses.endwin()
+
+    def GetLineCount(self):
+        return self.__lines
+
     def Clear(self):
-        if (self.__stdscr is not None):
-            self.__stdscr.clear()
-    
+        self.__frame = self.__BlankFrame()
+        self.__column = 0
+        self.__line = 0
+        self.__inFrame = True
+
     def SetCursor(self, column, line):
-        if (self.__stdscr is not None):
-            self.__stdscr.move(line, column)
+        self.__column = column
+        self.__line = line
 
     def Print(self, msg):
-        if (self.__stdscr is not None):
-            self.__stdscr.addstr(msg)
-            self.__stdscr.refresh()
+        if (0 <= self.__line < self.__lines) and (self.__column < self.__columns):
+            text = self.__frame[self.__line]
+            end = min(self.__column + len(msg), self.__columns)
+            self.__frame[self.__line] = text[:self.__column] + msg[:end - self.__column] + text[end:]
+            self.__column = end
+        if not self.__inFrame:
+            self.Refresh()
+
+    def Refresh(self):
+        """ Ends the current frame and puts it on screen. """
+        self.__inFrame = False
+        with self.__lock:
+            self.__pending = list(self.__frame)
+        if self.__thread is None:
+            self.__Render()
         else:
-            print(msg)
+            self.__renderEvent.set()
+
+    def __BlankFrame(self):
+        return [' ' * self.__columns] * self.__lines
+
+    def __Render(self):
+        with self.__lock:
+            frame = self.__pending
+            self.__pending = None
+        if frame is None:
+            return
+        changed = False
+        for line in range(self.__lines):
+            previous = self.__screen[line]
+            text = frame[line]
+            if previous == text:
+                continue
+            changed = True
+            self.__screen[line] = text
+            if (self.__stdscr is None):
+                print(text.rstrip())
+                continue
+            if previous is None:
+                previous = ''
+            # Only write the span of cells that differ
+            start = 0
+            while (start < len(text)) and (start < len(previous)) and (text[start] == previous[start]):
+                start += 1
+            end = len(text)
+            while (end > start) and (end <= len(previous)) and (text[end - 1] == previous[end - 1]):
+                end -= 1
+            try:
+                self.__stdscr.addstr(line, start, text[start:end])
+            except self.__curses.error:
+                # Writing the bottom right cell moves the cursor off screen
+                pass
+        if changed and (self.__stdscr is not None):
+            self.__stdscr.refresh()
+
+    def __Run(self):
+        while not self.__stopEvent.is_set():
+            self.__renderEvent.wait()
+            self.__renderEvent.clear()
+            self.__Render()
 
 if __name__ == '__main__':
+    import time
     lcd = LCD()
     try:
+        count = 0
         while True:
             lcd.Clear()
             lcd.SetCursor(0, 0)
             lcd.Print("Line 0")
             lcd.SetCursor(0, 1)
-            lcd.Print("Line 1")
+            lcd.Print("Line 1: " + str(count))
+            lcd.Refresh()
+            count += 1
+            time.sleep(0.1)
     except KeyboardInterrupt as e:
         pass
     lcd.Cleanup()
@@ -2,6 +2,7 @@
 from i2c import I2CDevice
 from datetime import datetime
 import time
+import threading
 
 
 I2CBus = 1
@@ -53,9 +54,14 @@ class MCP23008SequentialOperation(object):
     Enabled = 0
     Disabled = 1
 
+
+class MCP23008InterruptControl(object):
+    # INTCON: interrupt on any change, or when the pin differs from its DEFVAL bit
+    CompareWithPrevious = 0
+    CompareWithDefault = 1
+
 # MCP23008 I/O Expander driver
 # Datasheet: http://ww1.microchip.com/downloads/en/DeviceDoc/21919e.pdf
-# To do: implement interrupt handling
 class MCP23008(object):
     def __init__(self, I2CDevice):
         self.__i2cDevice = I2CDevice
@@ -64,6 +70,9 @@ class MCP23008(object):
         self.__OLAT = 0x00
         self.__GPPU = 0x00
         self.__IPOL = 0x00
+        self.__GPINTEN = 0x00
+        self.__DEFVAL = 0x00
+        self.__INTCON = 0x00
 
     def PinMode(self, pin, direction = MCP23008PinDirection.Output):
         self.__IODIR = self.__SetBitState(self.__IODIR, pin, direction)
@@ -74,6 +83,14 @@ class MCP23008(object):
         self.__OLAT = self.__SetBitState(self.__OLAT, pin, state)
         self.__i2cDevice.WriteRegisterByte(MCP23008Register.GPIO, self.__OLAT)
         
+    def SetOutputPort(self, mask, states):
+        # Updates every output pin selected by mask with a single register write
+        for pin in range(0, 8):
+            if mask & (1 << pin):
+                self._RaiseNotOutputException(pin)
+        self.__OLAT = (self.__OLAT & ~mask & 0xFF) | (states & mask)
+        self.__i2cDevice.WriteRegisterByte(MCP23008Register.GPIO, self.__OLAT)
+
     def SetInputPullUp(self, pin, state = MCP23008Pullup.Enabled):
         self._RaiseNotInputException(pin)
         self.__GPPU = self.__SetBitState(self.__GPPU, pin, state)
@@ -89,6 +106,42 @@ class MCP23008(object):
         portState = self.__i2cDevice.ReadRegisterByte(MCP23008Register.GPIO)
         return portState & (1 << pin)
     
+    def EnableInterrupt(self, pin, control = MCP23008InterruptControl.CompareWithPrevious, defaultValue = MCP23008PinState.Low):
+        self._RaiseNotInputException(pin)
+        self.__GPINTEN = self.__SetBitState(self.__GPINTEN, pin, 1)
+        self.__INTCON = self.__SetBitState(self.__INTCON, pin, control)
+        self.__DEFVAL = self.__SetBitState(self.__DEFVAL, pin, defaultValue)
+        self.__WriteInterruptRegisters()
+
+    def DisableInterrupt(self, pin):
+        self.__GPINTEN = self.__SetBitState(self.__GPINTEN, pin, 0)
+        self.__WriteInterruptRegisters()
+
+    def SetInterruptOutput(self, activeHigh = False, openDrain = False):
+        iocon = self.__i2cDevice.ReadRegisterByte(MCP23008Register.IOCON)
+        iocon = self.__SetBitState(iocon, MCP23008IOConRegisterBits.INTPOL, 1 if activeHigh else 0)
+        iocon = self.__SetBitState(iocon, MCP23008IOConRegisterBits.ODR, 1 if openDrain else 0)
+        self.__i2cDevice.WriteRegisterByte(MCP23008Register.IOCON, iocon)
+
+    def GetInterruptFlags(self):
+        # Pins that caused the pending interrupt
+        return self.__i2cDevice.ReadRegisterByte(MCP23008Register.INTF)
+
+    def GetInterruptCapture(self):
+        # Port state when the interrupt occurred, reading it clears the interrupt
+        return self.__i2cDevice.ReadRegisterByte(MCP23008Register.INTCAP)
+
+    def __WriteInterruptRegisters(self):
+        # GPINTEN, DEFVAL and INTCON are consecutive: a CachedI2CDevice merges them into one transfer
+        batch = hasattr(self.__i2cDevice, 'Begin')
+        if batch:
+            self.__i2cDevice.Begin()
+        self.__i2cDevice.WriteRegisterByte(MCP23008Register.GPINTEN, self.__GPINTEN)
+        self.__i2cDevice.WriteRegisterByte(MCP23008Register.DEFVAL, self.__DEFVAL)
+        self.__i2cDevice.WriteRegisterByte(MCP23008Register.INTCON, self.__INTCON)
+        if batch:
+            self.__i2cDevice.Commit()
+
     def GetGPIOPortState(self):
         return self.__i2cDevice.ReadRegisterByte(MCP23008Register.GPIO)
     
@@ -96,6 +149,9 @@ class MCP23008(object):
         iocon = self.__i2cDevice.ReadRegisterByte(MCP23008Register.IOCON)
         iocon = self.__SetBitState(iocon, MCP23008IOConRegisterBits.SEQOP, state)
         self.__i2cDevice.WriteRegisterByte(MCP23008Register.IOCON, iocon)
+        if hasattr(self.__i2cDevice, 'SetSequential'):
+            # Let a CachedI2CDevice know whether it may merge writes into block transfers
+            self.__i2cDevice.SetSequential(state == MCP23008SequentialOperation.Enabled)
     
     def SetStreamRegister(self, register = MCP23008Register.GPIO):
         self.SetSequentialOperationState()
@@ -118,21 +174,90 @@ class MCP23008(object):
         if (self.__IODIR & (1 << pin)) != 0:
             raise Exception("Pin " + str(pin) + " is not an output")
 
-def InputTest(mcp = None):    
+class MCP23008InterruptMonitor(object):
+    """ Waits for edges on the Raspberry Pi GPIO line wired to the MCP23008 INT pin (active low, BCM numbering)
+    and only then reads INTF/INTCAP, calling the handler registered for each pin that changed with
+    (pin, state). Runs on its own thread, the bus is left alone while nothing happens.
+    """
+    WAIT_TIMEOUT_MS = 500
+    # Back-to-back reads while INT stays asserted, before backing off to WAIT_TIMEOUT_MS polling
+    MAX_DISPATCHES = 8
+
+    def __init__(self, mcp, intPin, gpio = None):
+        if gpio is None:
+            import RPi.GPIO as gpio
+        self.__mcp = mcp
+        self.__intPin = intPin
+        self.__GPIO = gpio
+        self.__handlers = dict()
+        self.__stopEvent = threading.Event()
+        self.__thread = None
+        self.__GPIO.setmode(self.__GPIO.BCM)
+        self.__GPIO.setup(intPin, self.__GPIO.IN, pull_up_down = self.__GPIO.PUD_UP)
+
+    def AddHandler(self, pin, handler, control = MCP23008InterruptControl.CompareWithPrevious, defaultValue = MCP23008PinState.Low):
+        self.__handlers[pin] = handler
+        self.__mcp.EnableInterrupt(pin, control, defaultValue)
+
+    def Start(self):
+        if self.__thread is not None:
+            return
+        self.__stopEvent.clear()
+        # Clear an interrupt left pending by an earlier run, or INT would stay asserted
+        self.__mcp.GetInterruptCapture()
+        self.__thread = threading.Thread(target = self.__Run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def Stop(self):
+        if self.__thread is None:
+            return
+        self.__stopEvent.set()
+        self.__thread.join()
+        self.__thread = None
+
+    def __Run(self):
+        while not self.__stopEvent.is_set():
+            if self.__GPIO.input(self.__intPin) != 0:
+                # The timeout only bounds how long Stop() waits
+                if self.__GPIO.wait_for_edge(self.__intPin, self.__GPIO.FALLING, timeout = self.WAIT_TIMEOUT_MS) is None:
+                    continue
+            # Another change may have been latched while dispatching: INT is then still asserted
+            for dispatch in range(self.MAX_DISPATCHES):
+                self.__Dispatch()
+                if self.__GPIO.input(self.__intPin) != 0:
+                    break
+            else:
+                # Stuck low, e.g. the expander does not answer or a pin is held away from DEFVAL: poll instead of spinning
+                self.__stopEvent.wait(self.WAIT_TIMEOUT_MS / 1000.0)
+
+    def __Dispatch(self):
+        try:
+            flags = self.__mcp.GetInterruptFlags()
+            capture = self.__mcp.GetInterruptCapture()
+        except IOError:
+            return
+        for pin in range(0, 8):
+            if (flags & (1 << pin)) and (pin in self.__handlers):
+                self.__handlers[pin](pin, (capture >> pin) & 1)
+
+
+def InputTest(mcp = None, intPin = 4):
     print("InputTest(): all pins as inputs with pullups enabled, waiting for a change on pin 0")
     for pin in range(0,8):
         mcp.PinMode(pin, MCP23008PinDirection.Input)
         mcp.SetInputPullUp(pin)
     currentState = mcp.GetInputState(0)
     print("Pin 0 state: " + str(currentState))
-    while True:
-        try:
-            state = mcp.GetInputState(0)
-            if state != currentState:
-                print("Pin 0 new state: " + str(state))
-                break
-        except IOError:
-            pass
+    changed = threading.Event()
+    def OnChange(pin, state):
+        print("Pin " + str(pin) + " new state: " + str(state))
+        changed.set()
+    monitor = MCP23008InterruptMonitor(mcp, intPin)
+    monitor.AddHandler(0, OnChange)
+    monitor.Start()
+    changed.wait()
+    monitor.Stop()
 
 def OutputTest(mcp = None):
     iterations = 0
@@ -0,0 +1,122 @@
+#!/usr/bin/python
+#
+# Multi-oven reflow controller
+# Runs one ReflowStateMachine per oven in a single process. The relays of all ovens
+# share one MCP23008: every tick steps the ovens that are due, then pushes all relay
+# states to the expander with a single register write.
+#
+import argparse
+from reflowctl import ReflowStateMachine, ReflowState
+from thermocouple import *
+from relayinterface import *
+from clock import GetDefaultClock, VirtualClock
+from gains import LoadGainTable
+
+
+class MultiOvenController(object):
+    MAX_OVENS = 8
+
+    def __init__(self, ovens, bank = None, clock = None):
+        """ ovens is a list of ReflowStateMachine sharing clock, bank the MCP23008RelayBank driving their relays. """
+        if (clock is None):
+            clock = GetDefaultClock()
+        if len(ovens) > self.MAX_OVENS:
+            raise Exception("An MCP23008 drives at most " + str(self.MAX_OVENS) + " ovens")
+        self.__ovens = list(ovens)
+        self.__bank = bank
+        self.__clock = clock
+
+    def Step(self):
+        """ Steps every oven whose next event is due and flushes the relay bank once.
+        Returns the ovens that completed their cycle during this tick.
+        """
+        now = self.__clock.Now()
+        completed = list()
+        for oven in self.__ovens:
+            if (oven.NextDeadline() <= now):
+                if oven.Step():
+                    completed.append(oven)
+        if (self.__bank is not None):
+            self.__bank.Flush()
+        for oven in completed:
+            self.__ovens.remove(oven)
+        return completed
+
+    def NextDeadline(self):
+        return min(oven.NextDeadline() for oven in self.__ovens)
+
+    def IsRunning(self):
+        return len(self.__ovens) > 0
+
+    def Reflow(self, onComplete = None):
+        while self.IsRunning():
+            for oven in self.Step():
+                if onComplete is not None:
+                    onComplete(oven)
+            if self.IsRunning():
+                self.__clock.SleepUntil(self.NextDeadline())
+
+
+def OpenRelayBank(i2cbus, i2caddr):
+    from i2c import I2CDevice, CachedI2CDevice
+    from mcp23008 import MCP23008
+    # The expander powers up in sequential mode
+    return MCP23008RelayBank(MCP23008(CachedI2CDevice(I2CDevice(i2cbus, i2caddr), sequential = True)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Multi-oven Reflow Controller", usage='%(prog)s [options] [parameter]')
+    parser.add_argument('--profile', nargs=1, type=str, required=True, help='built-in reflow profile name or profile file')
+    parser.add_argument('--therm', nargs=1, type=str, required=True, help='thermocouple type to be used')
+    parser.add_argument('--interface', nargs=1, type=str, default=['MCP23008BankRelay'], help='relay interface (default: MCP23008BankRelay)')
+    parser.add_argument('--pins', nargs='+', type=int, required=True, help='MCP23008 pin # of each oven relay')
+    parser.add_argument('--aliases', nargs='*', type=str, help='1-Wire alias of each oven thermocouple, in pin order')
+    parser.add_argument('--gains', nargs='*', type=str, help='per-oven PID gain tables, in pin order')
+    parser.add_argument('--i2cbus', nargs=1, type=int, default=[1], help='Relay interface I2C bus #')
+    parser.add_argument('--i2caddr', nargs=1, type=int, default=[0x20], help='Relay interface I2C address (decimal)')
+    parser.add_argument('--virtualclock', nargs='*', help='run on virtual time, as fast as possible (simulated backends only)')
+    args = vars(parser.parse_args())
+
+    _clock = GetDefaultClock()
+    if args['virtualclock'] is not None:
+        _clock = VirtualClock()
+    _bank = None
+    if args['interface'][0] == 'MCP23008BankRelay':
+        _bank = OpenRelayBank(args['i2cbus'][0], args['i2caddr'][0])
+    tcf = ThermocoupleFactory()
+    rif = RelayInterfaceFactory()
+    relays = list()
+    ovens = list()
+    for index, pin in enumerate(args['pins']):
+        kwargs = {'pin': pin, 'bank': _bank, 'clock': _clock, 'simoven': str(pin)}
+        if args['aliases'] is not None:
+            kwargs['alias'] = args['aliases'][index]
+        gainTable = None
+        if args['gains'] is not None:
+            gainTable = LoadGainTable(args['gains'][index])
+        if _bank is not None:
+            relay = MCP23008BankRelay(kwargs)
+        else:
+            relay = rif.GetInstance(args['interface'][0], kwargs)
+        relays.append(relay)
+        ovens.append(ReflowStateMachine(
+            reflowProfile = args['profile'][0],
+            thermocouple = tcf.GetInstance(args['therm'][0], kwargs),
+            relay = relay,
+            clock = _clock,
+            gainTable = gainTable))
+
+    def OnComplete(oven):
+        index = ovens.index(oven)
+        if oven.GetState() in (ReflowState.REFLOW_STATE_ERROR, ReflowState.REFLOW_STATE_ABORTED):
+            print("Oven on pin " + str(args['pins'][index]) + ": " + ReflowState.Messages[oven.GetState()])
+        else:
+            print("Oven on pin " + str(args['pins'][index]) + ": " + ReflowState.Messages[ReflowState.REFLOW_STATE_COMPLETE])
+
+    controller = MultiOvenController(ovens, _bank, _clock)
+    try:
+        controller.Reflow(OnComplete)
+    except KeyboardInterrupt:
+        pass
+    for relay in relays:
+        relay.Cleanup()
@@ -2,11 +2,41 @@
 import os
 import pickle
 import argparse
+import glob
+import time
+import threading
+from registry import ONEWIRE_DEVICES
+
+class OneWireDeviceStats(object):
+    def __init__(self):
+        self.Reads = 0
+        self.CrcErrors = 0
+        self.ReadErrors = 0
+        self.Faults = 0
+        self.Timeouts = 0
+        self.LastLatency = 0.0
+        self.MaxLatency = 0.0
+        self.TotalLatency = 0.0
+
+    def GetMeanLatency(self):
+        if self.Reads == 0:
+            return 0.0
+        return self.TotalLatency / self.Reads
+
+    def __str__(self):
+        return ("reads=%d crc=%d ioerr=%d faults=%d timeouts=%d latency last=%.0fms mean=%.0fms max=%.0fms" % (
+            self.Reads, self.CrcErrors, self.ReadErrors, self.Faults, self.Timeouts,
+            self.LastLatency * 1000.0, self.GetMeanLatency() * 1000.0, self.MaxLatency * 1000.0))
+
 
 class OneWire(object):
-    def __init__(self, prefix = None, maxReadAttempts = 5):
+    RETRY_DELAY = 0.01
+
+    def __init__(self, prefix = None, maxReadAttempts = 5, maxReadTime = 1.0):
         self.__devices = dict()
         self.__MaxReadAttempts = maxReadAttempts
+        self.__MaxReadTime = maxReadTime
+        self.__stats = dict()
         self.Prefix = prefix
 
     def EnumerateDevices(self):
@@ -64,24 +94,119 @@ class OneWire(object):
                 return False
         return True
 
-    def ReadRawData(self, deviceId):
+    def GetDegreesCelsius(self, deviceId, dev = None):
+        data = self.ReadRawData(deviceId, dev)
+        fault = self.GetFault(data)
+        if fault is not None:
+            self.GetStats(deviceId).Faults += 1
+            raise Exception("Thermocouple fault on " + deviceId + ": " + fault)
+        return self.DecodeCelsius(data)
+
+    def DecodeCelsius(self, data):
+        raise Exception("Not implemented")
+
+    def GetFault(self, data):
+        return None
+
+    def ReadRawData(self, deviceId, dev = None):
+        """ Reads the scratchpad of a device, retrying bad CRCs and I/O errors with an increasing delay.
+        Gives up with an exception once maxReadAttempts or the maxReadTime budget are spent.
+        An open sysfs handle of the device may be passed in to avoid reopening it.
+        """
         if (self.ContainsPrefix(deviceId) == False):
             raise Exception("Prefix " + self.GetPrefix() + " not found in device ID " + deviceId)
-        with open("/sys/bus/w1/devices/" + deviceId + "/w1_slave") as dev:
-            readAttempts = self.__MaxReadAttempts
-            while readAttempts != 0:
-                devData = dev.read()
-                records = devData.split("\n")
-                if records[0].find("YES") > 0:
-                    hexData = records[1][:23].split(" ")
-                    index = 0
-                    for b in hexData:
-                        hexData[index] = int(b, 16)
-                        index += 1
+        stats = self.GetStats(deviceId)
+        start = time.monotonic()
+        ownHandle = dev is None
+        try:
+            if ownHandle:
+                dev = open(self.GetDevicePath(deviceId))
+        except IOError as e:
+            stats.ReadErrors += 1
+            raise Exception("Cannot open " + deviceId + ": " + str(e))
+        try:
+            delay = self.RETRY_DELAY
+            attempts = 0
+            while True:
+                attempts += 1
+                hexData = None
+                attemptStart = time.monotonic()
+                try:
+                    if dev is None:
+                        dev = open(self.GetDevicePath(deviceId))
+                        ownHandle = True
+                    # Rewind so that each attempt reads a new record
+                    dev.seek(0)
+                    hexData = self.ParseRawData(dev.read())
+                    if hexData is None:
+                        stats.CrcErrors += 1
+                except (IOError, OSError):
+                    stats.ReadErrors += 1
+                    # The kernel may have dropped and re-enumerated the slave: retry on a new handle
+                    if ownHandle and dev is not None:
+                        dev.close()
+                    dev = None
+                now = time.monotonic()
+                elapsed = now - start
+                attemptTime = now - attemptStart
+                if hexData is not None:
+                    stats.Reads += 1
+                    stats.LastLatency = elapsed
+                    stats.MaxLatency = max(stats.MaxLatency, elapsed)
+                    stats.TotalLatency += elapsed
                     return hexData
-                else:
-                    readAttempts -= 1
-            raise Exception("Bad CRC reading " + deviceId)
+                # Another attempt will likely block as long as this one did (a conversion is ~750ms): only
+                # start it if it can finish within the budget
+                if (attempts >= self.__MaxReadAttempts) or ((elapsed + delay + attemptTime) > self.__MaxReadTime):
+                    stats.Timeouts += 1
+                    raise Exception("No valid data from " + deviceId + " after " + str(attempts) +
+                                    " attempts in " + str(int(elapsed * 1000)) + "ms")
+                time.sleep(delay)
+                delay *= 2
+        finally:
+            if ownHandle and dev is not None:
+                dev.close()
+
+    def ParseRawData(self, devData):
+        # w1_slave holds two records: '<9 bytes> : crc=<xx> YES|NO' and '<9 bytes> t=<value>'
+        records = devData.split("\n")
+        if (len(records) < 2) or (records[0].rstrip().endswith("YES") == False):
+            return None
+        try:
+            return bytearray.fromhex(records[1][:23])
+        except ValueError:
+            return None
+
+    def GetStats(self, deviceId):
+        stats = self.__stats.get(deviceId)
+        if stats is None:
+            stats = self.__stats.setdefault(deviceId, OneWireDeviceStats())
+        return stats
+
+    def GetMaxReadTime(self):
+        return self.__MaxReadTime
+
+    def GetBusMasters(self):
+        return sorted(glob.glob('/sys/bus/w1/devices/w1_bus_master*'))
+
+    def StartBulkConversion(self):
+        # Starts a temperature conversion on every sensor of each bus master supporting it.
+        # The w1_slave reads that follow return these results instead of converting again.
+        triggered = False
+        for master in self.GetBusMasters():
+            try:
+                with open(os.path.join(master, 'therm_bulk_read'), 'w') as f:
+                    f.write('trigger\n')
+                triggered = True
+            except IOError:
+                pass
+        return triggered
+
+    def GetDevicePath(self, deviceId):
+        return "/sys/bus/w1/devices/" + deviceId + "/w1_slave"
+
+    def GetMaxReadAttempts(self):
+        return self.__MaxReadAttempts
 
     def ContainsPrefix(self, deviceId):
         if deviceId.__contains__(self.Prefix):
@@ -98,29 +223,33 @@ class OneWire(object):
         return (self.RawDataToCelsius(raw) * 1.8 + 32.0)
 
 class DS18B20(OneWire):
+    PREFIX = "28-"
     def __init__(self, kwargs):
-        super(DS18B20, self).__init__(prefix = "28-")
+        super(DS18B20, self).__init__(prefix = DS18B20.PREFIX)
 
-    def GetDegreesCelsius(self, deviceId):
-        data = self.ReadRawData(deviceId)
+    def DecodeCelsius(self, data):
         # 12-bit temp resolution by default
         rawTemp = (data[1] << 8) | (data[0] & 0xF0)
         return self.RawDataToCelsius(rawTemp)
 
 
 class MAX31850K(OneWire):
+    PREFIX = "3b-"
     def __init__(self, kwargs):
-        super(MAX31850K, self).__init__(prefix = "3b-")
+        super(MAX31850K, self).__init__(prefix = MAX31850K.PREFIX)
 
-    def GetDegreesCelsius(self, deviceId):
-        data= self.ReadRawData(deviceId)
+    def GetFault(self, data):
         if (data[0] & 0x01):
             if (data[2] & 0x01):
-                raise Exception("Thermocouple fault: open circuit!")
+                return "open circuit!"
             elif (data[2] & 0x02):
-                raise Exception("Thermocouple fault: short to GND!")
+                return "short to GND!"
             elif (data[2] & 0x04):
-                raise Exception("Thermocouple fault: short to VDD!")
+                return "short to VDD!"
+            return "unknown fault!"
+        return None
+
+    def DecodeCelsius(self, data):
         # 14-bit resolution by default
         rawTemp = (data[1] << 8) | (data[0] & 0xF8)
         return self.RawDataToCelsius(rawTemp)
@@ -129,15 +258,13 @@ class MAX31850K(OneWire):
 class OneWireFactory(object):
     def __init__(self, AliasConfigFilename):
         self.__aliasConfigFilename = AliasConfigFilename
-        self.__deviceClasses = self.__CreateDeviceClasses()
-        
-    def __CreateDeviceClasses(self):
-        classes = dict()
-        types = self.ListTypes()
-        for _type in types:
-            _class = self.GetInstance(_type, None)
-            classes[_class.GetPrefix()] = _class
-        return classes
+        # Device class instances by prefix, created on first use
+        self.__deviceClasses = dict()
+        self.__lock = threading.Lock()
+        self.__queryErrors = dict()
+        # Query() worker threads, kept between sweeps
+        self.__executor = None
+        self.__executorWorkers = 0
 
     def __Identify(self, deviceList, aliasList, degreeCelsiusDiff=3.0):
         temps = dict()
@@ -158,10 +285,29 @@ class OneWireFactory(object):
             deviceList[detectedDeviceId] = alias
             namedSensorCount += 1
 
+    def OpenSession(self, alias):
+        return OneWireSession(self, self.__aliasConfigFilename, alias)
+
+    def GetInstanceByDeviceId(self, deviceId):
+        return self.__GetInstanceByDeviceId(deviceId)
+
     def __GetInstanceByDeviceId(self, deviceId):
+        # Query() workers resolve concurrently: one instance per prefix keeps the device stats in one place
+        with self.__lock:
+            return self.__ResolveDeviceClass(deviceId)
+
+    def __ResolveDeviceClass(self, deviceId):
         for k in self.__deviceClasses:
             if (deviceId.__contains__(k)):
                 return self.__deviceClasses[k]
+        for _type in ONEWIRE_DEVICES.ListTypes():
+            prefix = ONEWIRE_DEVICES.GetInfo(_type).get('prefix')
+            if prefix is None:
+                # Plugin device classes tell their prefix through a PREFIX attribute
+                prefix = getattr(ONEWIRE_DEVICES.GetClass(_type), 'PREFIX', None)
+            if (prefix is not None and deviceId.__contains__(prefix)):
+                self.__deviceClasses[prefix] = self.GetInstance(_type, None)
+                return self.__deviceClasses[prefix]
         raise Exception("No device class matches " + deviceId)
     
     def Setup(self, aliasList):
@@ -170,37 +316,126 @@ class OneWireFactory(object):
         oneWire.SaveAliasConfig(self.__aliasConfigFilename)
 
     def GetInstance(self, Type, kwargs):
-        types = self.ListTypes()
-        if types.__contains__(Type):
-            module = __import__(__name__)
-            _class = getattr(module, Type)
-            return _class(kwargs)
-        else:
-            raise Exception("Unsupported thermocouple type")
+        return ONEWIRE_DEVICES.GetInstance(Type, kwargs)
 
     def ListTypes(self):
-        types = list()
-        for _class in OneWire.__subclasses__():
-            classInfo = str(_class).split('.')
-            strippedClass = classInfo[1].strip('\'>')
-            types.append(strippedClass)
-        return types
+        return ONEWIRE_DEVICES.ListTypes()
     
     def Query(self):
-        sensorValues = dict()
+        """ Returns the temperature of every alias, None for the sensors that could not be read.
+        GetQueryErrors() tells why.
+        """
+        self.__queryErrors = dict()
         oneWire = OneWire()
         oneWire.LoadAliasConfig(self.__aliasConfigFilename)
         aliases = oneWire.GetAliases()
-        for alias in aliases:
-            while True:
-                try:
-                    devId = oneWire.ResolveAlias(alias)
-                    _class = self.__GetInstanceByDeviceId(devId)
-                    sensorValues[alias] = _class.GetDegreesCelsius(devId)
-                    break
-                except Exception:
-                    pass
-        return sensorValues
+        if len(aliases) == 0:
+            return dict()
+        # One conversion for the whole bus, then collect every result concurrently:
+        # a sweep takes about one conversion time whatever the number of sensors
+        oneWire.StartBulkConversion()
+        values = self.__GetExecutor(len(aliases)).map(lambda alias: self.__QueryAlias(oneWire, alias), aliases)
+        return dict(zip(aliases, values))
+
+    def Close(self):
+        if self.__executor is not None:
+            self.__executor.shutdown()
+            self.__executor = None
+            self.__executorWorkers = 0
+
+    def GetQueryErrors(self):
+        return self.__queryErrors
+
+    def GetStats(self):
+        """ Returns the read statistics of every device read through this factory, by device ID. """
+        oneWire = OneWire()
+        oneWire.LoadAliasConfig(self.__aliasConfigFilename)
+        stats = dict()
+        for alias in oneWire.GetAliases():
+            devId = oneWire.ResolveAlias(alias)
+            stats[alias] = self.__GetInstanceByDeviceId(devId).GetStats(devId)
+        return stats
+
+    def __GetExecutor(self, workers):
+        if (self.__executor is None or self.__executorWorkers < workers):
+            from concurrent.futures import ThreadPoolExecutor
+            self.Close()
+            self.__executor = ThreadPoolExecutor(max_workers = workers)
+            self.__executorWorkers = workers
+        return self.__executor
+
+    def __QueryAlias(self, oneWire, alias):
+        try:
+            devId = oneWire.ResolveAlias(alias)
+            _class = self.__GetInstanceByDeviceId(devId)
+            return _class.GetDegreesCelsius(devId)
+        except Exception as e:
+            self.__queryErrors[alias] = e
+            return None
+
+
+class OneWireSession(object):
+    """ Reads a single aliased sensor without going through OneWireFactory.Query().
+    The alias map is loaded and resolved once, the sysfs handle is kept open between reads,
+    and everything is reloaded only when the alias config file changes on disk.
+    """
+    def __init__(self, factory, aliasConfigFilename, alias):
+        self.__factory = factory
+        self.__aliasConfigFilename = aliasConfigFilename
+        self.__alias = alias
+        self.__configMTime = None
+        self.__deviceId = None
+        self.__deviceClass = None
+        self.__dev = None
+
+    def GetDeviceId(self):
+        self.__Refresh()
+        return self.__deviceId
+
+    def ReadCelsius(self):
+        self.__Refresh()
+        return self.__Read(self.__deviceClass.GetDegreesCelsius)
+
+    def ReadRawData(self):
+        self.__Refresh()
+        return self.__Read(self.__deviceClass.ReadRawData)
+
+    def GetStats(self):
+        self.__Refresh()
+        return self.__deviceClass.GetStats(self.__deviceId)
+
+    def Close(self):
+        if self.__dev is not None:
+            self.__dev.close()
+            self.__dev = None
+
+    def __Read(self, read):
+        stats = self.__deviceClass.GetStats(self.__deviceId)
+        readErrors = stats.ReadErrors
+        try:
+            return read(self.__deviceId, self.__dev)
+        finally:
+            # The handle failed, e.g. the slave was re-enumerated: open the device again on the next read
+            if stats.ReadErrors != readErrors:
+                self.Close()
+
+    def __Refresh(self):
+        try:
+            mtime = os.stat(self.__aliasConfigFilename).st_mtime
+        except OSError:
+            mtime = None
+        if (self.__dev is not None and mtime == self.__configMTime):
+            return
+        self.Close()
+        oneWire = OneWire()
+        oneWire.LoadAliasConfig(self.__aliasConfigFilename)
+        deviceId = oneWire.ResolveAlias(self.__alias)
+        if deviceId is None:
+            raise Exception("Unknown 1-Wire alias: " + self.__alias)
+        self.__deviceClass = self.__factory.GetInstanceByDeviceId(deviceId)
+        self.__deviceId = deviceId
+        self.__dev = open(self.__deviceClass.GetDevicePath(deviceId))
+        self.__configMTime = mtime
 
 
 def GetSetup(args):
@@ -215,6 +450,12 @@ def GetQuery(args):
     except:
         return None
 
+def GetStats(args):
+    try:
+        return args['stats']
+    except:
+        return None
+
 def GetAliasList(args):
     try:
         return args['aliases']
@@ -235,8 +476,17 @@ def OnCommand(args):
             owf.Setup(GetAliasList(args))
         elif (GetQuery(args) is not None):
             d = owf.Query()
+            errors = owf.GetQueryErrors()
             for k in d:
-                print("Device '" + k + "' = " + str(d[k]))
+                if k in errors:
+                    print("Device '" + k + "' error: " + str(errors[k]))
+                else:
+                    print("Device '" + k + "' = " + str(d[k]))
+            if (GetStats(args) is not None):
+                stats = owf.GetStats()
+                for k in stats:
+                    print("Device '" + k + "' " + str(stats[k]))
+            owf.Close()
     else:
         raise("Missing parameters")
 
@@ -245,6 +495,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="OneWire Bus Helper", usage='%(prog)s [options] [parameter]')
     parser.add_argument('--setup', nargs='*', help='Discover and save alias configuration of 1-Wire devices to a file')
     parser.add_argument('--query', nargs='*', help='Query 1-Wire devices by alias using configuration file')
+    parser.add_argument('--stats', nargs='*', help='Print read statistics of each device after a query')
     parser.add_argument('--cfgfile', nargs=1, type=str, help='Name of the config file')
     parser.add_argument('--aliases', nargs='*', type=str, help='One or more aliases to assign to 1-Wire devices')
 
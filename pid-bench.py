@@ -0,0 +1,71 @@
+#!/usr/bin/python
+#
+# Microbenchmark of the control loop hot path: PID.Compute() and ReflowStateMachine.Step()
+#
+import timeit
+from pid import PID, PIDContext
+from clock import VirtualClock
+from thermocouple import ThermocoupleFactory
+from relayinterface import RelayInterfaceFactory
+from reflowctl import ReflowStateMachine
+
+ITERATIONS = 200000
+
+class BenchClock(object):
+    # Lock-free stand-in for VirtualClock, so that only the controller is measured
+    def __init__(self):
+        self.Time = 0.0
+
+    def Now(self):
+        return self.Time
+
+def BenchCompute():
+    clock = BenchClock()
+    pidContext = PIDContext(20.0, 0.0, 150.0)
+    pid = PID(pidContext, 300.0, 0.05, 350.0, PID.DIRECT, clock = clock)
+    pid.SetOutputLimits(0.0, 2000.0)
+    pid.SetSampleTime(1000)
+    pid.SetMode(PID.AUTOMATIC)
+    def Iteration():
+        clock.Time += 1.0
+        pid.Compute()
+    return Iteration
+
+class BenchThermocouple(object):
+    # Constant reading: the cycle stays in preheat, every deadline is a PID step or a relay edge
+    def ReadCelsius(self):
+        return 25.0
+
+class BenchRelay(object):
+    def SwitchRelay(self, state):
+        pass
+
+def BenchDeadlineStep():
+    clock = BenchClock()
+    reflowCtl = ReflowStateMachine('leadfree', BenchThermocouple(), BenchRelay(), clock = clock)
+    # Time jumps to each deadline, as in Reflow(): every Step() has work to do
+    def Iteration():
+        reflowCtl.Step()
+        clock.Time = reflowCtl.NextDeadline()
+    return Iteration
+
+def BenchStep():
+    clock = VirtualClock()
+    kwargs = {'clock': clock, 'simoven': 'bench'}
+    reflowCtl = ReflowStateMachine('leadfree',
+                                   ThermocoupleFactory().GetInstance('SimulatedOven', kwargs),
+                                   RelayInterfaceFactory().GetInstance('SimulatedOven', kwargs),
+                                   clock = clock)
+    # Steps without moving time: measures the controller, not the thermal model
+    def Iteration():
+        reflowCtl.Step()
+        reflowCtl.NextDeadline()
+    reflowCtl.Step()
+    reflowCtl.Step()
+    return Iteration
+
+if __name__ == '__main__':
+    for name, bench in (('PID.Compute()', BenchCompute), ('Step() before the deadline', BenchStep),
+                        ('Step() at each deadline', BenchDeadlineStep)):
+        seconds = min(timeit.repeat(bench(), number = ITERATIONS, repeat = 3))
+        print("%-28s %.2f us/iteration" % (name, seconds * 1e6 / ITERATIONS))
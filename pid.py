@@ -25,17 +25,53 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see http://www.gnu.org/licenses/
 #
-from datetime import datetime, timedelta
+from clock import GetDefaultClock
 
 class PIDContext(object):
     Input = 0
     Output = 1
     SetPoint = 2
+    __slots__ = ('InputValue', 'OutputValue', 'SetPointValue', '__params')
     def __init__(self, _input, _output, _setpoint):
-        self.Params = [_input, _output, _setpoint]
+        self.InputValue = _input
+        self.OutputValue = _output
+        self.SetPointValue = _setpoint
+        self.__params = PIDParams(self)
+
+    @property
+    def Params(self):
+        # List-like view indexed by Input, Output and SetPoint, for existing callers
+        return self.__params
+
+
+class PIDParams(object):
+    __slots__ = ('__context',)
+    _Names = ('InputValue', 'OutputValue', 'SetPointValue')
+    def __init__(self, context):
+        self.__context = context
+
+    def __getitem__(self, index):
+        return getattr(self.__context, PIDParams._Names[index])
+
+    def __setitem__(self, index, value):
+        setattr(self.__context, PIDParams._Names[index], value)
+
+    def __len__(self):
+        return len(PIDParams._Names)
+
+    def __iter__(self):
+        return iter([self[index] for index in range(len(self))])
+
+    def __str__(self):
+        return str(list(self))
+
+    __repr__ = __str__
 
 
 class PID(object):
+    __slots__ = ('__clock', '__context', '__InAuto', '__SampleTimeMs', '__SampleTime', '__LastTime', '__NextTime',
+                 '__DispKp', '__DispKi', '__DispKd', '__kp', '__ki', '__kd', '__OutMin', '__OutMax',
+                 '__ITerm', '__LastInput', '__ControllerDirection')
     AUTOMATIC = 1
     MANUAL = 0
     DIRECT = 0
@@ -44,15 +80,22 @@ class PID(object):
     """ Constructor
     links the PID to the Input, Output, and Setpoint. Initial tuning parameters are also set here.
     The parameters specified here are those for for which we can't set up reliable defaults, so we need to have the user set them.
+    The optional clock (see clock.py) lets the PID run on virtual time.
     """
-    def __init__(self, pidContext, Kp, Ki, Kd, direction):
+    def __init__(self, pidContext, Kp, Ki, Kd, direction, clock=None):
+        if (clock is None):
+            clock = GetDefaultClock()
+        self.__clock = clock
         self.__context = pidContext
         self.__InAuto = False
         self.SetOutputLimits()
         self.__SampleTimeMs = PID.DefaultPidSamplingTimeMs
-        self.SetControllerDirection(direction)
+        self.__SampleTime = self.__SampleTimeMs / 1000.0
+        self.__ControllerDirection = direction
         self.SetTunings(Kp, Ki, Kd)
-        self.__LastTime = datetime.now() - timedelta(milliseconds = self.__SampleTimeMs)
+        self.__ITerm = 0.0
+        self.__LastInput = 0.0
+        self.__SetLastTime(self.__clock.Now() - self.__SampleTime)
         
 
     """ Status Funcions
@@ -83,6 +126,19 @@ class PID(object):
        return self.__ControllerDirection
 
 
+    """ GetNextComputeTime()
+    Returns the clock time, in seconds, at which Compute() will produce its next output.
+    Lets the caller sleep until then instead of polling Compute().
+    """
+    def GetNextComputeTime(self):
+        return self.__NextTime
+
+
+    def __SetLastTime(self, lastTime):
+        self.__LastTime = lastTime
+        self.__NextTime = lastTime + self.__SampleTime
+
+
     """ SetTunings()
     This function allows the controller's dynamic performance to be adjusted. 
     It's called automatically from the constructor, but tunings can also be adjusted on the fly during normal operation.
@@ -95,7 +151,7 @@ class PID(object):
         self.__DispKi = Ki
         self.__DispKd = Kd
    
-        _SampleTimeInSec = self.__SampleTimeMs/1000.0
+        _SampleTimeInSec = self.__SampleTime
         self.__kp = Kp
         self.__ki = Ki * _SampleTimeInSec
         self.__kd = Kd / _SampleTimeInSec
@@ -115,6 +171,8 @@ class PID(object):
             self.__ki *= _ratio
             self.__kd /= _ratio
             self.__SampleTimeMs = NewSampleTimeMs
+            self.__SampleTime = NewSampleTimeMs / 1000.0
+            self.__SetLastTime(self.__LastTime)
         else:
             raise Exception("Sample time <= 0!")
 
@@ -133,10 +191,10 @@ class PID(object):
         self.__OutMax = Max;
  
         if (self.__InAuto == True):
-            if (self.__context.Params[PIDContext.Output] > self.__OutMax):
-                self.__context.Params[PIDContext.Output] = self.__OutMax
-            elif (self.__context.Params[PIDContext.Output] < self.__OutMin):
-                self.__context.Params[PIDContext.Output] = self.__OutMin
+            if (self.__context.OutputValue > self.__OutMax):
+                self.__context.OutputValue = self.__OutMax
+            elif (self.__context.OutputValue < self.__OutMin):
+                self.__context.OutputValue = self.__OutMin
 
             if (self.__ITerm > self.__OutMax):
                 self.__ITerm = self.__OutMax
@@ -160,8 +218,8 @@ class PID(object):
     Does all the things that need to happen to ensure a bumpless transfer from manual to automatic mode.
     """
     def __Initialize(self):
-        self.__ITerm = self.__context.Params[PIDContext.Output]
-        self.__LastInput = self.__context.Params[PIDContext.Input]
+        self.__ITerm = self.__context.OutputValue
+        self.__LastInput = self.__context.InputValue
         if (self.__ITerm > self.__OutMax):
             self.__ITerm = self.__OutMax
         elif (self.__ITerm < self.__OutMin):
@@ -193,31 +251,36 @@ class PID(object):
     def Compute(self):
         if (self.__InAuto == False):
             return False
-        _now = datetime.now()
-        _timeChange = (_now - self.__LastTime)
-        if (_timeChange >= timedelta(milliseconds=self.__SampleTimeMs)):
+        _now = self.__clock.Now()
+        # Compared against the same sum GetNextComputeTime() returns so a caller waking up on it is never early
+        if (_now >= self.__NextTime):
+            _context = self.__context
+            _outMin = self.__OutMin
+            _outMax = self.__OutMax
             # Compute all the working error variables
-            _input = self.__context.Params[PIDContext.Input]
-            _error = self.__context.Params[PIDContext.SetPoint] - _input
-            self.__ITerm += (self.__ki * _error)
-            if (self.__ITerm > self.__OutMax):
-                self.__ITerm = self.__OutMax
-            elif (self.__ITerm < self.__OutMin):
-                self.__ITerm = self.__OutMin
+            _input = _context.InputValue
+            _error = _context.SetPointValue - _input
+            _iTerm = self.__ITerm + (self.__ki * _error)
+            if (_iTerm > _outMax):
+                _iTerm = _outMax
+            elif (_iTerm < _outMin):
+                _iTerm = _outMin
+            self.__ITerm = _iTerm
             _dInput = (_input - self.__LastInput)
 
             # Compute PID Output
-            _output = self.__kp * _error + self.__ITerm - self.__kd * _dInput
+            _output = self.__kp * _error + _iTerm - self.__kd * _dInput
                       
-            if (_output > self.__OutMax):
-                _output = self.__OutMax
-            elif (_output < self.__OutMin):
-                _output = self.__OutMin
-            self.__context.Params[PIDContext.Output] = _output
+            if (_output > _outMax):
+                _output = _outMax
+            elif (_output < _outMin):
+                _output = _outMin
+            _context.OutputValue = _output
 
             # Remember some variables for next time
             self.__LastInput = _input
             self.__LastTime = _now
+            self.__NextTime = _now + self.__SampleTime
             return True
         else:
             return False
@@ -0,0 +1,4 @@
+#!/bin/bash
+./reflow.py --profile leadfree --therm SimulatedOven --interface SimulatedOven
+
+
@@ -6,11 +6,16 @@
 # Based on the original Arduino code by 'Rocket Scream Electronics'
 # https://github.com/rocketscream/Reflow-Oven-Controller
 #
+import time
 import argparse
 from reflowctl import ReflowStateMachine
 from thermocouple import *
 from relayinterface import *
 from lcd import LCD
+from clock import VirtualClock
+from gains import LoadGainTable
+from runlog import RunRecorder
+from reflowprofile import LoadProfile, ListProfiles
 
 def GetProfile(args):
     return args['profile'][0]
@@ -18,6 +23,9 @@ def GetProfile(args):
 def GetTherm(args):
     return args['therm'][0]
 
+def GetProfileList(args):
+    return args['profilelist']
+
 def GetThermList(args):
     return args['thermlist']
 
@@ -27,6 +35,51 @@ def GetInterfaceList(args):
 def GetInterface(args):
     return args['interface'][0]
 
+def GetSampler(args):
+    return args['sampler']
+
+def GetVirtualClock(args):
+    return args['virtualclock']
+
+def GetRunLog(args):
+    try:
+        return args['runlog'][0]
+    except TypeError:
+        return None
+
+def GetAutoTune(args):
+    return args['autotune']
+
+def GetGainFile(args):
+    return args['gains'][0]
+
+def GetRelayDriver(args):
+    return args['relaydriver']
+
+def GetHTTPPort(args):
+    try:
+        return args['http'][0]
+    except TypeError:
+        return None
+
+def GetIntPin(args):
+    try:
+        return args['intpin'][0]
+    except TypeError:
+        return None
+
+def GetDoorPin(args):
+    try:
+        return args['doorpin'][0]
+    except TypeError:
+        return None
+
+def GetStartPin(args):
+    try:
+        return args['startpin'][0]
+    except TypeError:
+        return None
+
 def PrintList(_list, title):
     print(title)
     for _type in _list:
@@ -43,42 +96,162 @@ def ArgsToDict(args):
             pass
     return kwargs
 
+def AutoTune(args, thermocouple, relay, lcd, clock):
+    from autotune import RelayAutoTuner
+    profile = LoadProfile(GetProfile(args))
+    tuner = RelayAutoTuner(thermocouple, relay, clock = clock, lcd = lcd)
+    try:
+        table = tuner.Tune(profile)
+    except KeyboardInterrupt:
+        return
+    table.Save(GetGainFile(args))
+
+def StartInterlocks(args, relay, reflowCtl):
+    # Door switch and start button on inputs of the relay's MCP23008, both closing to ground
+    if GetIntPin(args) is None:
+        return None
+    from mcp23008 import MCP23008InterruptMonitor, MCP23008PinDirection, MCP23008PinState
+    mcp = None
+    if hasattr(relay, 'GetExpander'):
+        mcp = relay.GetExpander()
+    if mcp is None:
+        raise Exception("The door interlock and start button need the MCP23008IO relay interface")
+    monitor = MCP23008InterruptMonitor(mcp, GetIntPin(args))
+    for pin in (GetDoorPin(args), GetStartPin(args)):
+        if pin is not None:
+            mcp.PinMode(pin, MCP23008PinDirection.Input)
+            mcp.SetInputPullUp(pin)
+    if GetDoorPin(args) is not None:
+        def OnDoor(pin, state):
+            if state == MCP23008PinState.High:
+                reflowCtl.Abort()
+        monitor.AddHandler(GetDoorPin(args), OnDoor)
+        if mcp.GetInputState(GetDoorPin(args)):
+            reflowCtl.Abort()
+    if GetStartPin(args) is not None:
+        def OnStart(pin, state):
+            if state == MCP23008PinState.Low:
+                reflowCtl.RequestStart()
+        monitor.AddHandler(GetStartPin(args), OnStart)
+    monitor.Start()
+    return monitor
+
 def OnCommand(args):   
     if GetThermList(args) is not None:
         factory = ThermocoupleFactory()
         PrintList(factory.ListTypes(), "Supported thermocouple types")
+    elif GetProfileList(args) is not None:
+        PrintList(ListProfiles(), "Built-in reflow profiles")
     elif GetInterfaceList(args) is not None:
         factory = RelayInterfaceFactory()
         PrintList(factory.ListTypes(), "Supported interface types")
     else:
         kwargs = ArgsToDict(args)
+        _clock = None
+        if GetVirtualClock(args) is not None:
+            _clock = VirtualClock()
+            kwargs['clock'] = _clock
         tcf = ThermocoupleFactory()       
         rif = RelayInterfaceFactory()
         _relay = rif.GetInstance(GetInterface(args), kwargs)
+        _thermocouple = tcf.GetInstance(GetTherm(args), kwargs)
+        _sampler = None
+        if GetSampler(args) is not None:
+            _sampler = ThermocoupleSampler(_thermocouple, ReflowStateMachine.SENSOR_SAMPLING_TIME, clock = _clock)
+            _sampler.Start()
         _lcd = LCD()
+        if GetAutoTune(args) is not None:
+            try:
+                AutoTune(args, _thermocouple, _relay, _lcd, _clock)
+            finally:
+                _relay.SwitchRelay(RelayInterface.OFF)
+                _relay.Cleanup()
+                if _sampler is not None:
+                    _sampler.Stop()
+                _lcd.Cleanup()
+            return
+        _relayDriver = None
+        if GetRelayDriver(args) is not None:
+            from relaydriver import RelayDriver
+            _relayDriver = RelayDriver(_relay, ReflowStateMachine.RELAY_WINDOW_SIZE, clock = _clock)
+        _recorder = None
+        if GetRunLog(args) is not None:
+            # strftime() patterns keep one log per cycle
+            _recorder = RunRecorder(time.strftime(GetRunLog(args)))
+        _publisher = None
+        _server = None
+        if GetHTTPPort(args) is not None:
+            from telemetry import TelemetryPublisher, TelemetryServer
+            _publisher = TelemetryPublisher(recorder = _recorder)
+            _publisher.Start()
+            _server = TelemetryServer(_publisher, GetHTTPPort(args), args['httphost'][0])
+            _server.Start()
         reflowCtl = ReflowStateMachine(
             reflowProfile = GetProfile(args),
-            thermocouple = tcf.GetInstance(GetTherm(args), kwargs),
+            thermocouple = _thermocouple,
             relay = _relay,
-            lcd = _lcd)
+            lcd = _lcd,
+            sampler = _sampler,
+            clock = _clock,
+            gainTable = LoadGainTable(GetGainFile(args)),
+            recorder = _publisher or _recorder,
+            waitForStart = GetStartPin(args) is not None,
+            relayDriver = _relayDriver)
+        _monitor = StartInterlocks(args, _relay, reflowCtl)
+        if _relayDriver is not None:
+            _relayDriver.Start()
         try:
             reflowCtl.Reflow()
         except KeyboardInterrupt:
             _relay.SwitchRelay(RelayInterface.OFF)
+        if _monitor is not None:
+            _monitor.Stop()
+        if _relayDriver is not None:
+            _relayDriver.Stop()
+            print("Relay edge timing error: max %.1fms over %d windows" % (
+                _relayDriver.GetMaxEdgeError() * 1000.0, _relayDriver.GetWindowCount()))
+        if _server is not None:
+            _server.Stop()
+            _publisher.Stop()
+        if _sampler is not None:
+            _sampler.Stop()
+        if _recorder is not None:
+            _recorder.Close()
         _lcd.Cleanup()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Reflow Oven Controller", usage='%(prog)s [options] [parameter]')
-    parser.add_argument('--profile', nargs=1, type=str, choices={'leaded', 'leadfree'}, help='lead-based or lead-free reflow profile')
+    parser.add_argument('--profile', nargs=1, type=str, help='built-in reflow profile name (e.g. leaded, leadfree) or profile file')
+    parser.add_argument('--profilelist', nargs='*', help='list built-in reflow profiles')
     parser.add_argument('--therm', nargs=1, type=str, help='thermocouple type to be used')
     parser.add_argument('--thermlist', nargs='*', help='list thermocouple types')
     parser.add_argument('--interface', nargs=1, type=str, help='interface to the relay driving the reflow oven')
     parser.add_argument('--interfacelist', nargs='*', help='list relay interfaces')
+    parser.add_argument('--sampler', nargs='*', help='read the thermocouple from a background thread')
+    parser.add_argument('--autotune', nargs='*', help='measure the oven and write its PID gain table instead of reflowing')
+    parser.add_argument('--gains', nargs=1, type=str, default=['gains.json'], help='per-oven PID gain table (default: gains.json)')
+    parser.add_argument('--runlog', nargs=1, type=str, help='binary run log file, strftime() patterns allowed')
+    parser.add_argument('--http', nargs=1, type=int, help='stream telemetry as Server-Sent Events on this HTTP port (GET /events)')
+    parser.add_argument('--httphost', nargs=1, type=str, default=['127.0.0.1'], help='HTTP telemetry address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--virtualclock', nargs='*', help='run on virtual time, as fast as possible (simulated backends only)')
+    parser.add_argument('--spibus', nargs=1, type=int, help='SPI thermocouple bus #')
+    parser.add_argument('--spidevice', nargs=1, type=int, help='SPI thermocouple chip select #')
+    parser.add_argument('--spifile', nargs=1, type=str, help='replay SPI thermocouple frames from a file instead')
+    parser.add_argument('--oversample', nargs=1, type=int, help='SPI thermocouple conversions averaged per reading')
+    parser.add_argument('--relaydriver', nargs='*', help='time the relay window from a dedicated thread (real time only)')
+    parser.add_argument('--intpin', nargs=1, type=int, help='Raspberry Pi GPIO # (BCM) wired to the MCP23008 INT pin')
+    parser.add_argument('--doorpin', nargs=1, type=int, help='MCP23008 pin # of the door switch, an open door aborts the cycle')
+    parser.add_argument('--startpin', nargs=1, type=int, help='MCP23008 pin # of the start button, the cycle waits for it')
     parser.add_argument('--pin', nargs=1, type=int, help='Pin # connected to the relay interface')
     parser.add_argument('--i2cbus', nargs=1, type=int, help='Relay interface I2C bus #')
     parser.add_argument('--i2caddr', nargs=1, type=int, help='Relay interface I2C address (decimal)')
 
     args = vars(parser.parse_args())
+    if GetSampler(args) is not None and GetVirtualClock(args) is not None:
+        # The sampler thread waits in real time while virtual time races ahead
+        parser.error("--sampler needs the real clock, it cannot be used with --virtualclock")
+    if GetRelayDriver(args) is not None and GetVirtualClock(args) is not None:
+        parser.error("--relaydriver needs the real clock, it cannot be used with --virtualclock")
     if 'help' in args:
         parser.parse_args("--help")
         exit()
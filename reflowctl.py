@@ -6,53 +6,12 @@
 # Based on the original Arduino code by 'Rocket Scream Electronics'
 # https://github.com/rocketscream/Reflow-Oven-Controller
 #
-from datetime import datetime, timedelta
+from clock import GetDefaultClock
 from pid import PID, PIDContext
 from thermocouple import *
 from relayinterface import *
 from lcd import LCD
-
-class ReflowLeadFreeProfile(object):
-    # PID PARAMETERS
-    # PRE-HEAT STAGE
-    PID_KP_PREHEAT = 100
-    PID_KI_PREHEAT = 0.025
-    PID_KD_PREHEAT = 20
-    # SOAKING STAGE
-    PID_KP_SOAK = 300
-    PID_KI_SOAK = 0.05
-    PID_KD_SOAK = 250
-    # REFLOW STAGE
-    PID_KP_REFLOW = 300
-    PID_KI_REFLOW = 0.05
-    PID_KD_REFLOW = 350
-    PID_SAMPLE_TIME = 1000
-    # Temperature profile
-    TEMPERATURE_SOAK_MIN = 150
-    TEMPERATURE_SOAK_MAX = 200
-    TEMPERATURE_REFLOW_MAX = 250
-    TEMPERATURE_COOL_MIN = 100
-
-class ReflowLeadedProfile(object):
-    # PID PARAMETERS
-    # PRE-HEAT STAGE
-    PID_KP_PREHEAT = 300
-    PID_KI_PREHEAT = 0.05
-    PID_KD_PREHEAT = 350
-    # SOAKING STAGE
-    PID_KP_SOAK = 300
-    PID_KI_SOAK = 0.05
-    PID_KD_SOAK = 350
-    # REFLOW STAGE
-    PID_KP_REFLOW = 300
-    PID_KI_REFLOW = 0.05
-    PID_KD_REFLOW = 350
-    PID_SAMPLE_TIME = 1000
-    # Temperature profile
-    TEMPERATURE_SOAK_MIN = 150
-    TEMPERATURE_SOAK_MAX = 180
-    TEMPERATURE_REFLOW_MAX = 220
-    TEMPERATURE_COOL_MIN = 100
+from reflowprofile import LoadProfile
 
 class ReflowState(object):
     REFLOW_STATE_IDLE = 0
@@ -63,6 +22,7 @@ class ReflowState(object):
     REFLOW_STATE_COMPLETE = 5
     REFLOW_STATE_TOO_HOT = 6
     REFLOW_STATE_ERROR = 7
+    REFLOW_STATE_ABORTED = 8
 
     Messages = [
         "Ready to reflow",
@@ -72,7 +32,8 @@ class ReflowState(object):
         "Cooling phase",
         "Reflow cycle complete",
         "Please Wait, still too hot",
-        "Error"]
+        "Error",
+        "Reflow aborted"]
 
 
 class ReflowStatus(object):
@@ -86,172 +47,347 @@ class ReflowStateMachine(object):
     LEAD_FREE_PROFILE = 'leadfree'
     
     # Constants
-    TEMPERATURE_ROOM = 50
     SENSOR_SAMPLING_TIME = 1000
-    SOAK_TEMPERATURE_STEP = 5
-    SOAK_MICRO_PERIOD = 9000
+    RELAY_WINDOW_SIZE = 2000
+    MAX_SAMPLE_AGE = 3000
 
-    def __init__(self, reflowProfile, thermocouple = None, relay = None, lcd = None):
-        self.__reflowProfile = None
-        
-        if (reflowProfile == self.LEAD_FREE_PROFILE):
-            self.__reflowProfile = ReflowLeadFreeProfile()
+    # Profile stage driving the setpoint in each state
+    STAGES = {
+        ReflowState.REFLOW_STATE_PREHEAT: 'preheat',
+        ReflowState.REFLOW_STATE_SOAK: 'soak',
+        ReflowState.REFLOW_STATE_REFLOW: 'reflow',
+        ReflowState.REFLOW_STATE_COOL: 'cool'}
+
+    def __init__(self, reflowProfile, thermocouple = None, relay = None, lcd = None, sampler = None, clock = None, gainTable = None, recorder = None, waitForStart = False, relayDriver = None):
+        if (clock is None):
+            clock = GetDefaultClock()
+        self.__clock = clock
+        # Profile name, profile file or reflowprofile.CompiledProfile
+        if isinstance(reflowProfile, str):
+            self.__reflowProfile = LoadProfile(reflowProfile)
         else:
-            self.__reflowProfile = ReflowLeadedProfile()
+            self.__reflowProfile = reflowProfile
+
+        if (gainTable is not None):
+            # Oven specific gains, as measured by autotune.py
+            gainTable.Apply(self.__reflowProfile)
             
+        # Setpoint table of each stage, by state
+        self.__stageTables = dict()
+        for state, stage in self.STAGES.items():
+            self.__stageTables[state] = self.__reflowProfile.GetTable(stage)
+
         self.__reflowOvenPidContext = PIDContext(_input=0.0, _output=0.0, _setpoint=0.0)
         self.__reflowOvenPid = PID(self.__reflowOvenPidContext,
                                    Kp=self.__reflowProfile.PID_KP_PREHEAT,
                                    Ki=self.__reflowProfile.PID_KI_PREHEAT,
                                    Kd=self.__reflowProfile.PID_KD_PREHEAT,
-                                   direction=PID.DIRECT)
+                                   direction=PID.DIRECT,
+                                   clock=self.__clock)
         
         self.__thermocouple = thermocouple
         self.__relay = relay
         self.__lcd = lcd
-        self.__windowSize = 2000
-        self.__windowStartTime = datetime.now()
-        self.__nextCheck = datetime.now()
-        self.__nextRead = datetime.now()
-        self.__timerSoak = 0.0
+        self.__sampler = sampler
+        self.__recorder = recorder
+        self.__relayState = RelayInterface.OFF
+        self.__relayDriven = False
+        # Optional relaydriver.RelayDriver timing the relay window from its own thread
+        self.__relayDriver = relayDriver
+        self.__windowSize = self.RELAY_WINDOW_SIZE
+        # Hot path constants, in seconds
+        self.__windowTime = self.__windowSize / 1000.0
+        self.__samplingPeriod = self.SENSOR_SAMPLING_TIME / 1000.0
+        self.__maxSampleAge = self.MAX_SAMPLE_AGE / 1000.0
+        now = self.__clock.Now()
+        self.__windowStartTime = now
+        self.__nextCheck = now
+        self.__nextRead = now
+        self.__stageStartTime = now
+        self.__stageStartInput = 0.0
+        self.__liquidusTime = None
         self.__reflowState = ReflowState.REFLOW_STATE_IDLE
         self.__reflowStatus = ReflowStatus.REFLOW_STATUS_OFF
         self.__timerSeconds = 0.0
+        self.__reflowCycleComplete = False
+        self.__lastStepTime = now
+        self.__stateChanged = False
+        # Last NextDeadline() result, valid until the next full Step()
+        self.__deadline = now
+        self.__deadlineValid = False
+        # Set from other threads, e.g. by mcp23008.MCP23008InterruptMonitor handlers
+        self.__waitForStart = waitForStart
+        self.__startRequested = False
+        self.__abortRequested = False
 
 
     def Reflow(self):
-        reflowCycleComplete = False
-        now = datetime.now()
-        while (reflowCycleComplete == False):
-            # Time to read the thermocouple?
-            if (datetime.now() > self.__nextRead):
-                # Read thermocouple next sampling period
-                self.__nextRead += timedelta(milliseconds=self.SENSOR_SAMPLING_TIME)
-                # Read current temperature
-                try:
-                    self.__reflowOvenPidContext.Params[PIDContext.Input] = self.__thermocouple.ReadCelsius()
-                except Exception as e:
-                    # Thermocouple error
-                    self.__reflowState = ReflowState.REFLOW_STATE_ERROR
-                    self.__reflowStatus = ReflowStatus.REFLOW_STATUS_OFF
-            
-            if (datetime.now() > self.__nextCheck):
-                # Check the Input within the next second
-                self.__nextCheck += timedelta(milliseconds=1000)
-                # If reflow process is ongoing
-                if (self.__reflowStatus == ReflowStatus.REFLOW_STATUS_ON):
-                    self.__timerSeconds += 1
-                    
-                if (self.__lcd is not None):
-                    self.__lcd.Clear()
-                    self.__lcd.Print(ReflowState.Messages[self.__reflowState])
-                    self.__lcd.SetCursor(0, 1)
-                    
-                    if (self.__reflowState == ReflowState.REFLOW_STATE_ERROR):
-                        self.__lcd.Print("No thermocouple connected!")
-                    else:
-                        self.__lcd.Print(str(self.__reflowOvenPidContext.Params[PIDContext.Input]) + "C ")
-
-            # Reflow oven controller state machine
-            if (self.__reflowState == ReflowState.REFLOW_STATE_IDLE):
-                if (self.__reflowOvenPidContext.Params[PIDContext.Input] >= self.TEMPERATURE_ROOM):
-                    self.__reflowState = ReflowState.REFLOW_STATE_TOO_HOT
+        self.__reflowCycleComplete = False
+        while (self.Step() == False):
+            # Sleep until the next event is due instead of spinning
+            self.__clock.SleepUntil(self.NextDeadline())
+
+
+    def GetState(self):
+        return self.__reflowState
+
+
+    def RequestStart(self):
+        """ Starts a cycle that waits for a start request, e.g. from a front panel button. """
+        self.__startRequested = True
+
+
+    def Abort(self):
+        """ Turns the heater off and ends the cycle at the next Step(), e.g. when the oven door opens. """
+        self.__abortRequested = True
+
+
+    def NextDeadline(self):
+        # A state transition may enable another one right away: evaluate again without waiting
+        if (self.__stateChanged):
+            return self.__lastStepTime
+        if (self.__deadlineValid):
+            return self.__deadline
+        lastStepTime = self.__lastStepTime
+        stageStartTime = self.__stageStartTime
+        deadline = self.__nextRead
+        if (self.__nextCheck < deadline):
+            deadline = self.__nextCheck
+        table = self.__stageTables.get(self.__reflowState)
+        if (table is not None):
+            # Next entry of the stage's setpoint table
+            nextChange = table.GetNextChange(lastStepTime - stageStartTime)
+            if (nextChange is not None and lastStepTime < (stageStartTime + nextChange) < deadline):
+                deadline = stageStartTime + nextChange
+        if (self.__reflowState == ReflowState.REFLOW_STATE_SOAK):
+            soakEnd = stageStartTime + self.__reflowProfile.SOAK_TIME
+            if (soakEnd < deadline):
+                deadline = soakEnd
+        elif (self.__reflowState == ReflowState.REFLOW_STATE_REFLOW and self.__liquidusTime is not None):
+            liquidusDeadline = self.__liquidusTime + self.__reflowProfile.TIME_ABOVE_LIQUIDUS
+            if (lastStepTime < liquidusDeadline < deadline):
+                deadline = liquidusDeadline
+        if (self.__reflowStatus == ReflowStatus.REFLOW_STATUS_ON):
+            nextCompute = self.__reflowOvenPid.GetNextComputeTime()
+            if (nextCompute < deadline):
+                deadline = nextCompute
+            if (self.__relayDriver is None):
+                # Relay window edges: end of the 'on' portion and start of the next window
+                relayOffTime = self.__windowStartTime + (self.__reflowOvenPidContext.OutputValue / 1000.0)
+                if (lastStepTime < relayOffTime < deadline):
+                    deadline = relayOffTime
+                windowEnd = self.__windowStartTime + self.__windowTime
+                if (windowEnd < deadline):
+                    deadline = windowEnd
+        self.__deadline = deadline
+        self.__deadlineValid = True
+        return deadline
+
+
+    def Step(self):
+        now = self.__clock.Now()
+        # Nothing is due before the deadline handed out last, e.g. when several ovens share one loop:
+        # skip the pass unless another thread asked for something meanwhile
+        if (self.__deadlineValid and now < self.__deadline and not self.__abortRequested and not self.__startRequested):
+            return self.__reflowCycleComplete
+        self.__deadlineValid = False
+        self.__lastStepTime = now
+        previousState = self.__reflowState
+        previousStatus = self.__reflowStatus
+        _context = self.__reflowOvenPidContext
+        
+        # Time to read the thermocouple?
+        if (now >= self.__nextRead):
+            # Read thermocouple next sampling period
+            self.__nextRead += self.__samplingPeriod
+            # Read current temperature
+            try:
+                _context.InputValue = self.__ReadCelsius(now)
+            except Exception as e:
+                # Thermocouple error
+                self.__reflowState = ReflowState.REFLOW_STATE_ERROR
+                self.__reflowStatus = ReflowStatus.REFLOW_STATUS_OFF
+        
+        if (now >= self.__nextCheck):
+            # Check the Input within the next second
+            self.__nextCheck += 1.0
+            # If reflow process is ongoing
+            if (self.__reflowStatus == ReflowStatus.REFLOW_STATUS_ON):
+                self.__timerSeconds += 1
+                
+            if (self.__lcd is not None):
+                self.__lcd.Clear()
+                self.__lcd.Print(ReflowState.Messages[self.__reflowState])
+                self.__lcd.SetCursor(0, 1)
+                
+                if (self.__reflowState == ReflowState.REFLOW_STATE_ERROR):
+                    self.__lcd.Print("No thermocouple connected!")
                 else:
-                    # Intialize seconds timer for serial debug information
-                    self.__timerSeconds = 0
-                    # Initialize PID control window starting time
-                    self.__windowStartTime = datetime.now()
-                    # Ramp up to minimum soaking temperature
-                    self.__reflowOvenPidContext.Params[PIDContext.SetPoint] = self.__reflowProfile.TEMPERATURE_SOAK_MIN
-                    # Tell the PID to range between 0 and the full window size
-                    self.__reflowOvenPid.SetOutputLimits(0.0, self.__windowSize)
-                    self.__reflowOvenPid.SetSampleTime(self.__reflowProfile.PID_SAMPLE_TIME)
-                    # Turn the PID on
-                    self.__reflowOvenPid.SetMode(PID.AUTOMATIC)
-                    # Proceed to preheat stage
-                    self.__reflowState = ReflowState.REFLOW_STATE_PREHEAT
-                    
-            elif (self.__reflowState == ReflowState.REFLOW_STATE_PREHEAT):
-                self.__reflowStatus = ReflowStatus.REFLOW_STATUS_ON
-                # If minimum soak temperature is achieved
-                if (self.__reflowOvenPidContext.Params[PIDContext.Input] >= self.__reflowProfile.TEMPERATURE_SOAK_MIN):
-                    # Chop soaking period into smaller sub-periods
-                    self.__timerSoak = datetime.now() + timedelta(milliseconds=self.SOAK_MICRO_PERIOD)
-                    # Set less agressive PID parameters for soaking ramp
-                    self.__reflowOvenPid.SetTunings(
-                        Kp=self.__reflowProfile.PID_KP_SOAK,
-                        Ki=self.__reflowProfile.PID_KI_SOAK,
-                        Kd=self.__reflowProfile.PID_KD_SOAK)
-                    # Ramp up to first section of soaking temperature
-                    self.__reflowOvenPidContext.Params[PIDContext.SetPoint] = self.__reflowProfile.TEMPERATURE_SOAK_MIN + self.SOAK_TEMPERATURE_STEP
-                    # Proceed to soaking state
-                    self.__reflowState = ReflowState.REFLOW_STATE_SOAK
-                    
-            elif (self.__reflowState == ReflowState.REFLOW_STATE_SOAK):
-                # If micro soak temperature is achieved
-                if (datetime.now() > self.__timerSoak):
-                    self.__timerSoak = (datetime.now() + timedelta(milliseconds=self.SOAK_MICRO_PERIOD))
-                    # Increment micro setpoint
-                    self.__reflowOvenPidContext.Params[PIDContext.SetPoint] += self.SOAK_TEMPERATURE_STEP
-                    if (self.__reflowOvenPidContext.Params[PIDContext.SetPoint] > self.__reflowProfile.TEMPERATURE_SOAK_MAX):
-                        # Set agressive PID parameters for reflow ramp
-                        self.__reflowOvenPid.SetTunings(
-                            Kp=self.__reflowProfile.PID_KP_REFLOW,
-                            Ki=self.__reflowProfile.PID_KI_REFLOW,
-                            Kd=self.__reflowProfile.PID_KD_REFLOW)
-                        # Ramp up to first section of reflow temperature
-                        self.__reflowOvenPidContext.Params[PIDContext.SetPoint] = self.__reflowProfile.TEMPERATURE_REFLOW_MAX
-                        # Proceed to reflowing state
-                        self.__reflowState = ReflowState.REFLOW_STATE_REFLOW
-                        
-            elif (self.__reflowState == ReflowState.REFLOW_STATE_REFLOW):
-                # We need to avoid hovering at peak temperature for too long
-                # Crude method that works like a charm and safe for the components
-                if (self.__reflowOvenPidContext.Params[PIDContext.Input] >= (self.__reflowProfile.TEMPERATURE_REFLOW_MAX - 5)):
-                    # Set PID parameters for cooling ramp
-                    self.__reflowOvenPid.SetTunings(
-                            Kp=self.__reflowProfile.PID_KP_REFLOW,
-                            Ki=self.__reflowProfile.PID_KI_REFLOW,
-                            Kd=self.__reflowProfile.PID_KD_REFLOW)
-                    # Ramp down to minimum cooling temperature
-                    self.__reflowOvenPidContext.Params[PIDContext.SetPoint] = self.__reflowProfile.TEMPERATURE_COOL_MIN
-                    # Proceed to cooling state
-                    self.__reflowState = ReflowState.REFLOW_STATE_COOL
+                    self.__lcd.Print(str(_context.InputValue) + "C ")
+                if (self.__reflowStatus == ReflowStatus.REFLOW_STATUS_ON and self.__lcd.GetLineCount() > 3):
+                    self.__lcd.SetCursor(0, 2)
+                    self.__lcd.Print("Setpoint %.1fC Output %d%%" % (
+                        _context.SetPointValue,
+                        100.0 * _context.OutputValue / self.__windowSize))
+                    self.__lcd.SetCursor(0, 3)
+                    self.__lcd.Print("Stage %ds Total %ds" % (now - self.__stageStartTime, self.__timerSeconds))
+                self.__lcd.Refresh()
+
+        if (self.__abortRequested):
+            self.__abortRequested = False
+            self.__reflowState = ReflowState.REFLOW_STATE_ABORTED
+            self.__reflowStatus = ReflowStatus.REFLOW_STATUS_OFF
+
+        # Reflow oven controller state machine
+        if (self.__reflowState == ReflowState.REFLOW_STATE_IDLE):
+            if (self.__waitForStart and not self.__startRequested):
+                # Wait for the start button
+                pass
+            elif (_context.InputValue >= self.__reflowProfile.TEMPERATURE_START):
+                self.__reflowState = ReflowState.REFLOW_STATE_TOO_HOT
+            else:
+                # Intialize seconds timer for serial debug information
+                self.__timerSeconds = 0
+                # Initialize PID control window starting time
+                self.__windowStartTime = now
+                self.__startRequested = False
+                # Ramp up to minimum soaking temperature
+                self.__EnterStage(ReflowState.REFLOW_STATE_PREHEAT, now)
+                # Tell the PID to range between 0 and the full window size
+                self.__reflowOvenPid.SetOutputLimits(0.0, self.__windowSize)
+                self.__reflowOvenPid.SetSampleTime(self.__reflowProfile.PID_SAMPLE_TIME)
+                # Turn the PID on
+                self.__reflowOvenPid.SetMode(PID.AUTOMATIC)
+                
+        elif (self.__reflowState == ReflowState.REFLOW_STATE_PREHEAT):
+            self.__reflowStatus = ReflowStatus.REFLOW_STATUS_ON
+            # If minimum soak temperature is achieved
+            if (_context.InputValue >= self.__reflowProfile.TEMPERATURE_SOAK_MIN):
+                # Set less agressive PID parameters for soaking ramp
+                self.__reflowOvenPid.SetTunings(
+                    Kp=self.__reflowProfile.PID_KP_SOAK,
+                    Ki=self.__reflowProfile.PID_KI_SOAK,
+                    Kd=self.__reflowProfile.PID_KD_SOAK)
+                # Proceed to soaking state
+                self.__EnterStage(ReflowState.REFLOW_STATE_SOAK, now)
+                
+        elif (self.__reflowState == ReflowState.REFLOW_STATE_SOAK):
+            # If the soak trajectory is over
+            if (now >= (self.__stageStartTime + self.__reflowProfile.SOAK_TIME)):
+                # Set agressive PID parameters for reflow ramp
+                self.__reflowOvenPid.SetTunings(
+                    Kp=self.__reflowProfile.PID_KP_REFLOW,
+                    Ki=self.__reflowProfile.PID_KI_REFLOW,
+                    Kd=self.__reflowProfile.PID_KD_REFLOW)
+                # Proceed to reflowing state
+                self.__EnterStage(ReflowState.REFLOW_STATE_REFLOW, now)
                     
-            elif (self.__reflowState == ReflowState.REFLOW_STATE_COOL):
-                # If minimum cool temperature is achieved
-                if (self.__reflowOvenPidContext.Params[PIDContext.Input] <= self.__reflowProfile.TEMPERATURE_COOL_MIN):
-                    # Turn off reflow process
-                    self.__reflowStatus = ReflowStatus.REFLOW_STATUS_OFF
-                    # Proceed to reflow Completion state
-                    self.__reflowState = ReflowState.REFLOW_STATE_COMPLETE
-            
-            elif (self.__reflowState == ReflowState.REFLOW_STATE_COMPLETE):
-                # Reflow process ended
-                self.__reflowState = ReflowState.REFLOW_STATE_IDLE
-                # Exit the state machine loop
-                reflowCycleComplete = True
+        elif (self.__reflowState == ReflowState.REFLOW_STATE_REFLOW):
+            if (self.__liquidusTime is None and _context.InputValue >= self.__reflowProfile.TEMPERATURE_LIQUIDUS):
+                self.__liquidusTime = now
+            timeAboveLiquidus = 0.0
+            if (self.__liquidusTime is not None):
+                timeAboveLiquidus = now - self.__liquidusTime
+            # We need to avoid hovering at peak temperature for too long
+            # Crude method that works like a charm and safe for the components
+            if ((_context.InputValue >= (self.__reflowProfile.TEMPERATURE_REFLOW_MAX - self.__reflowProfile.TEMPERATURE_PEAK_MARGIN)) and
+                (timeAboveLiquidus >= self.__reflowProfile.TIME_ABOVE_LIQUIDUS)):
+                # Set PID parameters for cooling ramp
+                self.__reflowOvenPid.SetTunings(
+                        Kp=self.__reflowProfile.PID_KP_COOL,
+                        Ki=self.__reflowProfile.PID_KI_COOL,
+                        Kd=self.__reflowProfile.PID_KD_COOL)
+                # Proceed to cooling state
+                self.__EnterStage(ReflowState.REFLOW_STATE_COOL, now)
                 
-            elif (self.__reflowState == ReflowState.REFLOW_STATE_TOO_HOT):
-                # If oven temperature drops below room temperature
-                if (self.__reflowOvenPidContext.Params[PIDContext.Input] < self.TEMPERATURE_ROOM):
-                    # Ready to reflow
-                    self.__reflowState = ReflowState.REFLOW_STATE_IDLE
-            
-            elif (self.__reflowState == ReflowState.REFLOW_STATE_ERROR):
-                # Exit the state machine loop
-                reflowCycleComplete = True
+        elif (self.__reflowState == ReflowState.REFLOW_STATE_COOL):
+            # If minimum cool temperature is achieved
+            if (_context.InputValue <= self.__reflowProfile.TEMPERATURE_COOL_MIN):
+                # Turn off reflow process
+                self.__reflowStatus = ReflowStatus.REFLOW_STATUS_OFF
+                # Proceed to reflow Completion state
+                self.__reflowState = ReflowState.REFLOW_STATE_COMPLETE
+        
+        elif (self.__reflowState == ReflowState.REFLOW_STATE_COMPLETE):
+            # Reflow process ended
+            self.__reflowState = ReflowState.REFLOW_STATE_IDLE
+            # Exit the state machine loop
+            self.__reflowCycleComplete = True
             
-            # PID computation and relay control
+        elif (self.__reflowState == ReflowState.REFLOW_STATE_TOO_HOT):
+            # If oven temperature drops below the profile's start temperature
+            if (_context.InputValue < self.__reflowProfile.TEMPERATURE_START):
+                # Ready to reflow
+                self.__reflowState = ReflowState.REFLOW_STATE_IDLE
+        
+        elif (self.__reflowState == ReflowState.REFLOW_STATE_ERROR or self.__reflowState == ReflowState.REFLOW_STATE_ABORTED):
+            # Exit the state machine loop
+            self.__reflowCycleComplete = True
+        
+        # Follow the compiled setpoint trajectory of the current stage
+        table = self.__stageTables.get(self.__reflowState)
+        if (table is not None):
+            _context.SetPointValue = table.GetSetpoint(now - self.__stageStartTime, self.__stageStartInput)
+
+        # PID computation and relay control
+        if (self.__relayDriver is not None):
             if (self.__reflowStatus == ReflowStatus.REFLOW_STATUS_ON):
-                now = datetime.now()
                 self.__reflowOvenPid.Compute()
-                if ((now - self.__windowStartTime) > timedelta(milliseconds=self.__windowSize)):
-                    # Time to shift the Relay Window
-                    self.__windowStartTime += timedelta(milliseconds=self.__windowSize)
-                if (timedelta(milliseconds=self.__reflowOvenPidContext.Params[PIDContext.Output]) > (now - self.__windowStartTime)):
-                    self.__relay.SwitchRelay(RelayInterface.ON)
-                else:
-                    self.__relay.SwitchRelay(RelayInterface.OFF)
+                self.__relayDriver.SetOutput(_context.OutputValue)
+            else:
+                self.__relayDriver.Off()
+            self.__relayState = self.__relayDriver.GetState()
+        elif (self.__reflowStatus == ReflowStatus.REFLOW_STATUS_ON):
+            self.__reflowOvenPid.Compute()
+            # Edges are compared as absolute times, exactly as NextDeadline() computes them
+            if (now >= (self.__windowStartTime + self.__windowTime)):
+                # Time to shift the Relay Window
+                self.__windowStartTime += self.__windowTime
+            if (now < (self.__windowStartTime + (_context.OutputValue / 1000.0))):
+                self.__SwitchRelay(RelayInterface.ON)
             else:
-                self.__relay.SwitchRelay(RelayInterface.OFF)
+                self.__SwitchRelay(RelayInterface.OFF)
+        else:
+            self.__SwitchRelay(RelayInterface.OFF)
+
+        if (self.__recorder is not None):
+            self.__recorder.Record(now, self.__reflowState, self.__relayState,
+                                   _context.InputValue,
+                                   _context.SetPointValue,
+                                   _context.OutputValue,
+                                   self.__reflowOvenPid.GetKp(),
+                                   self.__reflowOvenPid.GetKi(),
+                                   self.__reflowOvenPid.GetKd())
+
+        self.__stateChanged = ((self.__reflowState != previousState) or (self.__reflowStatus != previousStatus))
+        return self.__reflowCycleComplete
+
+
+    def __EnterStage(self, state, now):
+        self.__reflowState = state
+        self.__stageStartTime = now
+        self.__stageStartInput = self.__reflowOvenPidContext.InputValue
+        if (state == ReflowState.REFLOW_STATE_REFLOW):
+            self.__liquidusTime = None
+
+
+    def __SwitchRelay(self, state):
+        # Only edges reach the relay interface
+        if (state == self.__relayState and self.__relayDriven):
+            return
+        self.__relayState = state
+        self.__relayDriven = True
+        self.__relay.SwitchRelay(state)
+
+
+    def __ReadCelsius(self, now):
+        if (self.__sampler is None):
+            return self.__thermocouple.ReadCelsius()
+        # Sampler mode: use the newest background sample, provided it is recent enough
+        sample = self.__sampler.GetLatest()
+        if (sample is None):
+            raise Exception("No thermocouple sample available")
+        timestamp, celsius = sample
+        if ((now - timestamp) > self.__maxSampleAge):
+            raise Exception("Stale thermocouple sample")
+        return celsius
@@ -0,0 +1,397 @@
+#!/usr/bin/python
+#
+# Reflow oven daemon
+# Keeps the thermocouple, relay interface and compiled profiles of one oven warm between
+# cycles and takes commands over a Unix domain socket, one JSON object per line:
+#   {"command": "start", "profile": "leadfree"}
+#   {"command": "abort"}
+#   {"command": "status"}
+#   {"command": "profiles"}
+#   {"command": "subscribe"}
+# Every command gets one JSON reply line with an "ok" field. After replying to "subscribe",
+# the daemon streams telemetry events on the connection until the client closes it.
+#
+import os
+import json
+import stat
+import errno
+import queue
+import signal
+import socket
+import argparse
+import tempfile
+import threading
+import socketserver
+from reflowctl import ReflowStateMachine, ReflowState
+from thermocouple import ThermocoupleFactory, ThermocoupleSampler
+from relayinterface import RelayInterfaceFactory, RelayInterface
+from clock import GetDefaultClock, VirtualClock
+from gains import LoadGainTable
+from reflowprofile import LoadProfile, ListProfiles
+from telemetry import TelemetryPublisher, TelemetryServer
+
+
+def GetDefaultSocket():
+    """ $XDG_RUNTIME_DIR/reflowd.sock, or reflowd.sock in a private per-user directory of the temporary directory. """
+    runtimeDirectory = os.environ.get('XDG_RUNTIME_DIR')
+    if runtimeDirectory:
+        return os.path.join(runtimeDirectory, 'reflowd.sock')
+    return os.path.join(tempfile.gettempdir(), 'reflowd-' + str(os.getuid()), 'reflowd.sock')
+
+
+DEFAULT_SOCKET = GetDefaultSocket()
+
+
+class ReflowDaemon(object):
+    """ Runs one reflow cycle at a time on a thermocouple and relay opened once. """
+    def __init__(self, thermocouple, relay, clock = None, gainTable = None, sampler = None, publisher = None):
+        if (clock is None):
+            clock = GetDefaultClock()
+        if (publisher is None):
+            publisher = TelemetryPublisher()
+            publisher.Start()
+        self.__thermocouple = thermocouple
+        self.__relay = relay
+        self.__clock = clock
+        self.__gainTable = gainTable
+        self.__sampler = sampler
+        self.__publisher = publisher
+        self.__profiles = dict()
+        self.__lock = threading.Lock()
+        self.__reflowCtl = None
+        self.__thread = None
+        self.__jobCount = 0
+        self.__job = None
+
+    def GetPublisher(self):
+        return self.__publisher
+
+    def GetProfile(self, name):
+        """ Returns the compiled profile, with the oven gains applied, loading it on first use. """
+        with self.__lock:
+            profile = self.__profiles.get(name)
+            if profile is None:
+                profile = LoadProfile(name)
+                if (self.__gainTable is not None):
+                    self.__gainTable.Apply(profile)
+                self.__profiles[name] = profile
+            return profile
+
+    def IsRunning(self):
+        return self.__thread is not None and self.__thread.is_alive()
+
+    def Start(self, profileName):
+        """ Starts a cycle in the background and returns its job #. """
+        profile = self.GetProfile(profileName)
+        with self.__lock:
+            if self.IsRunning():
+                raise Exception("A reflow cycle is already running")
+            self.__jobCount += 1
+            self.__job = {'job': self.__jobCount, 'profile': profile.Name, 'start': self.__clock.Now(), 'end': None, 'result': None}
+            self.__reflowCtl = ReflowStateMachine(profile, self.__thermocouple, self.__relay, sampler = self.__sampler,
+                                                  clock = self.__clock, recorder = self.__publisher)
+            self.__thread = threading.Thread(target = self.__Run, args = (self.__reflowCtl, self.__job))
+            self.__thread.daemon = True
+            self.__thread.start()
+            return self.__jobCount
+
+    def Abort(self):
+        """ Returns False when no cycle is running. """
+        with self.__lock:
+            if not self.IsRunning():
+                return False
+            self.__reflowCtl.Abort()
+            return True
+
+    def Wait(self, timeout = None):
+        thread = self.__thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def GetStatus(self):
+        status = {'running': self.IsRunning(), 'job': None, 'sample': self.__publisher.GetLatest()}
+        job = self.__job
+        if job is not None:
+            status['job'] = dict(job)
+        reflowCtl = self.__reflowCtl
+        if reflowCtl is not None:
+            status['state'] = reflowCtl.GetState()
+            status['stateName'] = ReflowState.Messages[reflowCtl.GetState()]
+        return status
+
+    def Shutdown(self):
+        self.Abort()
+        self.Wait()
+        self.__relay.SwitchRelay(RelayInterface.OFF)
+
+    def __Run(self, reflowCtl, job):
+        self.__publisher.Publish('start', job = job['job'], profile = job['profile'])
+        try:
+            reflowCtl.Reflow()
+        except Exception as e:
+            self.__relay.SwitchRelay(RelayInterface.OFF)
+            job['error'] = str(e)
+        job['end'] = self.__clock.Now()
+        state = reflowCtl.GetState()
+        if state == ReflowState.REFLOW_STATE_IDLE:
+            # A completed cycle goes back to idle
+            state = ReflowState.REFLOW_STATE_COMPLETE
+        job['result'] = ReflowState.Messages[state]
+        self.__publisher.Publish('end', job = job['job'], profile = job['profile'], result = job['result'],
+                                 duration = job['end'] - job['start'])
+
+
+class ReflowRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        daemon = self.server.Daemon
+        for line in self.rfile:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            try:
+                request = json.loads(line.decode('utf-8'))
+                command = request.get('command')
+                if command == 'subscribe':
+                    self.__Subscribe(daemon.GetPublisher())
+                    return
+                reply = self.__Execute(daemon, command, request)
+                reply['ok'] = True
+            except Exception as e:
+                reply = {'ok': False, 'error': str(e)}
+            self.__Send(json.dumps(reply))
+
+    def __Execute(self, daemon, command, request):
+        if command == 'start':
+            if 'profile' not in request:
+                raise Exception("Missing profile")
+            return {'job': daemon.Start(request['profile'])}
+        elif command == 'abort':
+            return {'aborted': daemon.Abort()}
+        elif command == 'status':
+            return daemon.GetStatus()
+        elif command == 'profiles':
+            return {'profiles': ListProfiles()}
+        raise Exception("Unsupported command")
+
+    def __Subscribe(self, publisher):
+        subscription = publisher.Subscribe()
+        try:
+            self.__Send(json.dumps({'ok': True}))
+            while True:
+                try:
+                    line = subscription.Get(timeout = 1.0)
+                except queue.Empty:
+                    continue
+                if line is None:
+                    return
+                self.__Send(line)
+        except (IOError, OSError):
+            # Client went away
+            pass
+        finally:
+            subscription.Close()
+
+    def __Send(self, line):
+        self.wfile.write(line.encode('utf-8') + b'\n')
+        self.wfile.flush()
+
+
+class ReflowServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socketPath, daemon):
+        self.SocketPath = socketPath
+        self.__socketId = None
+        self.__PrepareDirectory()
+        self.__RemoveStaleSocket()
+        socketserver.UnixStreamServer.__init__(self, socketPath, ReflowRequestHandler)
+        self.Daemon = daemon
+
+    def server_bind(self):
+        socketserver.UnixStreamServer.server_bind(self)
+        # Anyone who can connect can start the oven
+        os.chmod(self.SocketPath, stat.S_IRUSR | stat.S_IWUSR)
+        info = os.stat(self.SocketPath)
+        self.__socketId = (info.st_dev, info.st_ino)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        # Only our own socket: another daemon may have taken the path over meanwhile
+        try:
+            info = os.stat(self.SocketPath)
+        except OSError:
+            return
+        if (info.st_dev, info.st_ino) == self.__socketId:
+            os.unlink(self.SocketPath)
+
+    def __PrepareDirectory(self):
+        directory = os.path.dirname(os.path.abspath(self.SocketPath))
+        if not os.path.isdir(directory):
+            os.makedirs(directory, stat.S_IRWXU)
+        if self.SocketPath == DEFAULT_SOCKET and not os.environ.get('XDG_RUNTIME_DIR'):
+            # Shared temporary directory: the per-user directory must not be someone else's
+            info = os.lstat(directory)
+            if (not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or
+                (info.st_mode & (stat.S_IRWXG | stat.S_IRWXO)) != 0):
+                raise Exception("Unsafe socket directory " + directory + ": it must be a directory private to this user")
+
+    def __RemoveStaleSocket(self):
+        try:
+            info = os.lstat(self.SocketPath)
+        except OSError:
+            return
+        if not stat.S_ISSOCK(info.st_mode):
+            raise Exception(self.SocketPath + " exists and is not a socket")
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.SocketPath)
+        except socket.error as e:
+            if e.errno != errno.ECONNREFUSED:
+                raise
+            # Left over by a daemon that is gone
+            os.unlink(self.SocketPath)
+            return
+        finally:
+            probe.close()
+        raise Exception("Another daemon is listening on " + self.SocketPath)
+
+
+class ReflowClient(object):
+    def __init__(self, socketPath = DEFAULT_SOCKET):
+        self.__socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.__socket.connect(socketPath)
+        self.__file = self.__socket.makefile('rwb')
+
+    def Command(self, command, **params):
+        params['command'] = command
+        self.__file.write(json.dumps(params).encode('utf-8') + b'\n')
+        self.__file.flush()
+        reply = self.__ReadLine()
+        if reply is None:
+            raise Exception("Connection closed by reflowd")
+        if not reply['ok']:
+            raise Exception(reply['error'])
+        return reply
+
+    def Start(self, profile):
+        return self.Command('start', profile = profile)['job']
+
+    def Abort(self):
+        return self.Command('abort')['aborted']
+
+    def GetStatus(self):
+        return self.Command('status')
+
+    def Subscribe(self):
+        """ Yields telemetry events until the daemon closes the connection. The client is not usable afterwards. """
+        self.Command('subscribe')
+        while True:
+            event = self.__ReadLine()
+            if event is None:
+                return
+            yield event
+
+    def Close(self):
+        self.__file.close()
+        self.__socket.close()
+
+    def __ReadLine(self):
+        line = self.__file.readline()
+        if len(line) == 0:
+            return None
+        return json.loads(line.decode('utf-8'))
+
+
+def RunClient(args):
+    client = ReflowClient(args['socket'][0])
+    try:
+        if args['start'] is not None:
+            print(json.dumps({'job': client.Start(args['start'][0])}))
+        elif args['abort'] is not None:
+            print(json.dumps({'aborted': client.Abort()}))
+        elif args['subscribe'] is not None:
+            for event in client.Subscribe():
+                print(json.dumps(event))
+        else:
+            print(json.dumps(client.GetStatus(), indent = 4))
+    except KeyboardInterrupt:
+        pass
+    client.Close()
+
+
+def RunDaemon(args):
+    kwargs = dict()
+    for k in args:
+        try:
+            kwargs[k] = args[k][0]
+        except (TypeError, IndexError):
+            pass
+    _clock = GetDefaultClock()
+    if args['virtualclock'] is not None:
+        _clock = VirtualClock()
+        kwargs['clock'] = _clock
+    _relay = RelayInterfaceFactory().GetInstance(args['interface'][0], kwargs)
+    _thermocouple = ThermocoupleFactory().GetInstance(args['therm'][0], kwargs)
+    _sampler = None
+    if args['sampler'] is not None:
+        _sampler = ThermocoupleSampler(_thermocouple, ReflowStateMachine.SENSOR_SAMPLING_TIME, clock = _clock)
+        _sampler.Start()
+    _publisher = TelemetryPublisher()
+    _publisher.Start()
+    daemon = ReflowDaemon(_thermocouple, _relay, clock = _clock, gainTable = LoadGainTable(args['gains'][0]),
+                          sampler = _sampler, publisher = _publisher)
+    for name in args['preload'] or list():
+        daemon.GetProfile(name)
+    _httpServer = None
+    if args['http'] is not None:
+        _httpServer = TelemetryServer(_publisher, args['http'][0], args['httphost'][0])
+        _httpServer.Start()
+    server = ReflowServer(args['socket'][0], daemon)
+
+    def OnTerminate(signum, frame):
+        # shutdown() waits for serve_forever() to return, which runs on this very thread
+        threading.Thread(target = server.shutdown).start()
+    signal.signal(signal.SIGTERM, OnTerminate)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    daemon.Shutdown()
+    if _httpServer is not None:
+        _httpServer.Stop()
+    _publisher.Stop()
+    if _sampler is not None:
+        _sampler.Stop()
+    _relay.Cleanup()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Reflow Oven Daemon", usage='%(prog)s [options] [parameter]')
+    parser.add_argument('--socket', nargs=1, type=str, default=[DEFAULT_SOCKET], help='Unix domain socket path (default: ' + DEFAULT_SOCKET + ')')
+    parser.add_argument('--therm', nargs=1, type=str, help='thermocouple type to be used')
+    parser.add_argument('--interface', nargs=1, type=str, help='interface to the relay driving the reflow oven')
+    parser.add_argument('--pin', nargs=1, type=int, help='Pin # connected to the relay interface')
+    parser.add_argument('--i2cbus', nargs=1, type=int, help='Relay interface I2C bus #')
+    parser.add_argument('--i2caddr', nargs=1, type=int, help='Relay interface I2C address (decimal)')
+    parser.add_argument('--sampler', nargs='*', help='read the thermocouple from a background thread')
+    parser.add_argument('--gains', nargs=1, type=str, default=['gains.json'], help='per-oven PID gain table (default: gains.json)')
+    parser.add_argument('--preload', nargs='*', type=str, help='profiles to compile at startup')
+    parser.add_argument('--http', nargs=1, type=int, help='stream telemetry as Server-Sent Events on this HTTP port (GET /events)')
+    parser.add_argument('--httphost', nargs=1, type=str, default=['127.0.0.1'], help='HTTP telemetry address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--virtualclock', nargs='*', help='run on virtual time, as fast as possible (simulated backends only)')
+    parser.add_argument('--start', nargs=1, type=str, help='client: start a cycle with this profile')
+    parser.add_argument('--abort', nargs='*', help='client: abort the running cycle')
+    parser.add_argument('--status', nargs='*', help='client: print the daemon status')
+    parser.add_argument('--subscribe', nargs='*', help='client: print telemetry events as they come')
+    args = vars(parser.parse_args())
+
+    if any(args[k] is not None for k in ('start', 'abort', 'status', 'subscribe')):
+        RunClient(args)
+    elif args['therm'] is None or args['interface'] is None:
+        parser.error("the daemon needs --therm and --interface")
+    elif args['sampler'] is not None and args['virtualclock'] is not None:
+        # The sampler thread waits in real time while virtual time races ahead
+        parser.error("--sampler needs the real clock, it cannot be used with --virtualclock")
+    else:
+        RunDaemon(args)
@@ -0,0 +1,206 @@
+#!/usr/bin/python
+#
+# Data-driven reflow profiles
+# Profiles are JSON files (see profiles/). Each one is compiled once into per-stage,
+# time-indexed setpoint tables that the control loop reads in O(1). Compiled profiles
+# are cached on disk, keyed by a hash of the profile file.
+#
+import os
+import json
+import pickle
+import hashlib
+import argparse
+from array import array
+
+
+PROFILE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles')
+CACHE_DIRECTORY = os.path.join(os.path.expanduser('~'), '.cache', 'reflow')
+# Bump when CompiledProfile changes so that stale cache entries are ignored
+COMPILER_VERSION = b'3'
+# Hottest oven temperature a cycle may start at, unless the profile sets 'startTemperature'
+TEMPERATURE_ROOM = 50
+
+
+class SetpointTable(object):
+    # How a table entry turns into a setpoint
+    ABSOLUTE = 0   # the entry is the setpoint
+    RISE = 1       # stage entry temperature + entry, capped at the target
+    FALL = 2       # stage entry temperature - entry, floored at the target
+
+    def __init__(self, kind, values, target, resolution):
+        self.Kind = kind
+        self.Values = array('d', values)
+        self.Target = float(target)
+        self.Resolution = float(resolution)
+
+    def GetSetpoint(self, elapsed, entryTemperature):
+        index = int((elapsed / self.Resolution) + 1e-9)
+        if index >= len(self.Values):
+            index = len(self.Values) - 1
+        value = self.Values[index]
+        if self.Kind == SetpointTable.RISE:
+            return min(entryTemperature + value, self.Target)
+        elif self.Kind == SetpointTable.FALL:
+            return max(entryTemperature - value, self.Target)
+        return value
+
+    def GetNextChange(self, elapsed):
+        """ Returns the stage elapsed time of the next table entry, or None past the end of the table. """
+        index = int((elapsed / self.Resolution) + 1e-9) + 1
+        if index >= len(self.Values):
+            return None
+        return index * self.Resolution
+
+
+class CompiledProfile(object):
+    STAGES = ('preheat', 'soak', 'reflow', 'cool')
+    TABLE_RESOLUTION = 1.0
+    # Longest ramp the tables have to cover, from 0C
+    MAX_RAMP_SPAN = 400.0
+
+    # Settings without a default, per stage
+    REQUIRED = (('preheat', ('gains',)), ('soak', ('minTemperature', 'maxTemperature', 'time', 'gains')),
+                ('reflow', ('peakTemperature', 'gains')), ('cool', ('minTemperature',)))
+
+    def __init__(self, name, data):
+        self.Name = name
+        for stage, keys in self.REQUIRED:
+            for key in keys:
+                if not isinstance(data.get(stage), dict) or key not in data[stage]:
+                    raise Exception("Invalid reflow profile " + name + ": missing " + stage + "." + key)
+        self.Description = data.get('description', name)
+        self.PID_SAMPLE_TIME = data.get('sampleTime', 1000)
+        preheat = data['preheat']
+        soak = data['soak']
+        reflow = data['reflow']
+        cool = data['cool']
+
+        self.TEMPERATURE_SOAK_MIN = soak['minTemperature']
+        self.TEMPERATURE_SOAK_MAX = soak['maxTemperature']
+        self.TEMPERATURE_REFLOW_MAX = reflow['peakTemperature']
+        self.TEMPERATURE_COOL_MIN = cool['minTemperature']
+        self.TEMPERATURE_PEAK_MARGIN = reflow.get('peakMargin', 5)
+        self.TEMPERATURE_LIQUIDUS = reflow.get('liquidusTemperature', self.TEMPERATURE_REFLOW_MAX)
+        self.TIME_ABOVE_LIQUIDUS = reflow.get('timeAboveLiquidus', 0)
+        self.SOAK_TIME = soak['time']
+        self.TEMPERATURE_START = data.get('startTemperature', TEMPERATURE_ROOM)
+        self.__Validate()
+
+        # The cooling stage keeps the reflow gains unless told otherwise
+        for stage, gains in (('preheat', preheat['gains']), ('soak', soak['gains']),
+                             ('reflow', reflow['gains']), ('cool', cool.get('gains', reflow['gains']))):
+            suffix = stage.upper()
+            setattr(self, 'PID_KP_' + suffix, gains['Kp'])
+            setattr(self, 'PID_KI_' + suffix, gains['Ki'])
+            setattr(self, 'PID_KD_' + suffix, gains['Kd'])
+
+        self.__tables = dict()
+        self.__tables['preheat'] = self.__CompileRamp(SetpointTable.RISE, preheat.get('rampRate', 0), self.TEMPERATURE_SOAK_MIN)
+        self.__tables['soak'] = self.__CompileSoak(soak.get('step', 0))
+        self.__tables['reflow'] = self.__CompileRamp(SetpointTable.RISE, reflow.get('rampRate', 0), self.TEMPERATURE_REFLOW_MAX)
+        self.__tables['cool'] = self.__CompileRamp(SetpointTable.FALL, cool.get('rampRate', 0), self.TEMPERATURE_COOL_MIN)
+
+    def GetTable(self, stage):
+        return self.__tables[stage]
+
+    def GetSetpoint(self, stage, elapsed, entryTemperature):
+        return self.__tables[stage].GetSetpoint(elapsed, entryTemperature)
+
+    def GetNextChange(self, stage, elapsed):
+        return self.__tables[stage].GetNextChange(elapsed)
+
+    def __Validate(self):
+        # Reject what would divide by zero or never leave a stage, instead of failing mid-cycle
+        checks = (
+            (self.PID_SAMPLE_TIME > 0, "sampleTime must be > 0"),
+            (self.SOAK_TIME > 0, "soak.time must be > 0"),
+            (self.TIME_ABOVE_LIQUIDUS >= 0, "reflow.timeAboveLiquidus must be >= 0"),
+            (self.TEMPERATURE_PEAK_MARGIN >= 0, "reflow.peakMargin must be >= 0"),
+            (self.TEMPERATURE_START <= self.TEMPERATURE_SOAK_MIN, "startTemperature must be <= soak.minTemperature"),
+            (self.TEMPERATURE_SOAK_MIN <= self.TEMPERATURE_SOAK_MAX, "soak.minTemperature must be <= soak.maxTemperature"),
+            (self.TEMPERATURE_SOAK_MAX < self.TEMPERATURE_REFLOW_MAX, "soak.maxTemperature must be < reflow.peakTemperature"),
+            (self.TEMPERATURE_LIQUIDUS <= self.TEMPERATURE_REFLOW_MAX, "reflow.liquidusTemperature must be <= reflow.peakTemperature"),
+            (self.TEMPERATURE_COOL_MIN < self.TEMPERATURE_REFLOW_MAX, "cool.minTemperature must be < reflow.peakTemperature"))
+        for valid, message in checks:
+            if not valid:
+                raise Exception("Invalid reflow profile " + self.Name + ": " + message)
+
+    def __CompileRamp(self, kind, rampRate, target):
+        if rampRate <= 0:
+            # Jump straight to the target
+            return SetpointTable(kind, [float('inf')], target, self.TABLE_RESOLUTION)
+        count = int(self.MAX_RAMP_SPAN / (rampRate * self.TABLE_RESOLUTION)) + 2
+        values = [rampRate * index * self.TABLE_RESOLUTION for index in range(count)]
+        return SetpointTable(kind, values, target, self.TABLE_RESOLUTION)
+
+    def __CompileSoak(self, step):
+        span = float(self.TEMPERATURE_SOAK_MAX - self.TEMPERATURE_SOAK_MIN)
+        count = max(1, int(round(self.SOAK_TIME / self.TABLE_RESOLUTION)))
+        values = list()
+        for index in range(count):
+            progress = (index * self.TABLE_RESOLUTION) / self.SOAK_TIME
+            if step > 0:
+                # Staircase: one step up at the start of every sub-period
+                steps = int((progress * span / step) + 1e-9) + 1
+                values.append(self.TEMPERATURE_SOAK_MIN + (steps * step))
+            else:
+                values.append(self.TEMPERATURE_SOAK_MIN + (progress * span))
+        return SetpointTable(SetpointTable.ABSOLUTE, values, self.TEMPERATURE_SOAK_MAX, self.TABLE_RESOLUTION)
+
+
+def ResolveProfilePath(name):
+    if os.path.isfile(name):
+        return name
+    path = os.path.join(PROFILE_DIRECTORY, name + '.json')
+    if os.path.isfile(path):
+        return path
+    raise Exception("Unknown reflow profile: " + name)
+
+
+def ListProfiles():
+    profiles = list()
+    for filename in sorted(os.listdir(PROFILE_DIRECTORY)):
+        if filename.endswith('.json'):
+            profiles.append(filename[:-len('.json')])
+    return profiles
+
+
+def LoadProfile(name, cacheDirectory = CACHE_DIRECTORY):
+    """ Returns the CompiledProfile for a built-in profile name or a profile file path.
+    Each call returns a new object, so callers may override its gains.
+    """
+    path = ResolveProfilePath(name)
+    with open(path, 'rb') as f:
+        data = f.read()
+    key = hashlib.sha1(COMPILER_VERSION + data).hexdigest()
+    cacheFile = None
+    if cacheDirectory is not None:
+        cacheFile = os.path.join(cacheDirectory, key + '.pickle')
+        try:
+            with open(cacheFile, 'rb') as f:
+                return pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError, AttributeError):
+            pass
+    profile = CompiledProfile(os.path.splitext(os.path.basename(path))[0], json.loads(data.decode('utf-8')))
+    if cacheFile is not None:
+        try:
+            if not os.path.isdir(cacheDirectory):
+                os.makedirs(cacheDirectory)
+            tempFile = cacheFile + '.' + str(os.getpid())
+            with open(tempFile, 'wb') as f:
+                pickle.dump(profile, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tempFile, cacheFile)
+        except (IOError, OSError):
+            pass
+    return profile
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Reflow profile compiler", usage='%(prog)s [options] [parameter]')
+    parser.add_argument('profile', nargs=1, type=str, help='profile name or file')
+    args = vars(parser.parse_args())
+    profile = LoadProfile(args['profile'][0])
+    print(profile.Description)
+    for stage in CompiledProfile.STAGES:
+        table = profile.GetTable(stage)
+        print(stage + ": " + str(len(table.Values)) + " entries, target " + str(table.Target) + "C")
@@ -0,0 +1,182 @@
+#!/usr/bin/python
+#
+# Backend registries
+# Map the thermocouple, relay interface and 1-Wire device type names to the 'module:Class'
+# implementing them. Listing types imports nothing; a backend module (and the hardware
+# libraries it needs) is only imported the first time that backend is instantiated.
+#
+# Installed packages add backends through entry points in the 'reflow.thermocouples',
+# 'reflow.relays' and 'reflow.onewire' groups, e.g. in a plugin's pyproject.toml:
+#   [project.entry-points."reflow.relays"]
+#   SSR = "myovens.ssr:SolidStateRelay"
+# Scanning the installed distributions is slow, so the result is cached on disk and only
+# redone when a distribution is installed, upgraded or removed.
+#
+import os
+import sys
+import json
+import argparse
+import importlib
+
+
+DISCOVERY_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'reflow', 'plugins.json')
+
+
+class BackendRegistry(object):
+    def __init__(self, kind, group = None):
+        self.__kind = kind
+        self.__group = group
+        self.__targets = dict()
+        self.__info = dict()
+        self.__classes = dict()
+
+    def GetGroup(self):
+        return self.__group
+
+    def Register(self, name, target, **info):
+        """ target is a 'module:Class' string, or the class itself. """
+        self.__targets[name] = target
+        self.__info[name] = info
+        self.__classes.pop(name, None)
+
+    def ListTypes(self):
+        DiscoverPlugins()
+        return sorted(self.__targets)
+
+    def Contains(self, name):
+        if name not in self.__targets:
+            DiscoverPlugins()
+        return name in self.__targets
+
+    def GetInfo(self, name):
+        return self.__info.get(name, dict())
+
+    def GetClass(self, name):
+        _class = self.__classes.get(name)
+        if _class is not None:
+            return _class
+        if not self.Contains(name):
+            raise Exception("Unsupported " + self.__kind)
+        target = self.__targets[name]
+        if isinstance(target, str):
+            moduleName, className = target.split(':')
+            _class = importlib.import_module(moduleName)
+            for attribute in className.split('.'):
+                _class = getattr(_class, attribute)
+        else:
+            _class = target
+        self.__classes[name] = _class
+        return _class
+
+    def GetInstance(self, name, kwargs):
+        return self.GetClass(name)(kwargs)
+
+
+THERMOCOUPLES = BackendRegistry('thermocouple type', 'reflow.thermocouples')
+THERMOCOUPLES.Register('Max31850', 'thermocouple:Max31850')
+THERMOCOUPLES.Register('Max31855', 'thermocouple:Max31855')
+THERMOCOUPLES.Register('Max6675', 'thermocouple:Max6675')
+THERMOCOUPLES.Register('SimulatedOven', 'thermocouple:SimulatedOven')
+
+RELAY_INTERFACES = BackendRegistry('relay interface', 'reflow.relays')
+RELAY_INTERFACES.Register('RPI', 'relayinterface:RPI')
+RELAY_INTERFACES.Register('MCP23008IO', 'relayinterface:MCP23008IO')
+RELAY_INTERFACES.Register('SimulatedOven', 'relayinterface:SimulatedOven')
+
+ONEWIRE_DEVICES = BackendRegistry('1-Wire device type', 'reflow.onewire')
+ONEWIRE_DEVICES.Register('DS18B20', 'onewire:DS18B20', prefix = '28-')
+ONEWIRE_DEVICES.Register('MAX31850K', 'onewire:MAX31850K', prefix = '3b-')
+
+REGISTRIES = (THERMOCOUPLES, RELAY_INTERFACES, ONEWIRE_DEVICES)
+
+_discovered = False
+
+
+def GetPathKey():
+    """ Identifies the set of installed packages: the distribution metadata found on sys.path, with modification times.
+    sys.path[0], the script directory, is left out: gain tables, run logs and __pycache__ land there on every run.
+    """
+    key = list()
+    for path in sys.path[1:]:
+        if not os.path.isdir(path or '.'):
+            # Zipped eggs and archives
+            try:
+                key.append([path, os.stat(path).st_mtime])
+            except OSError:
+                key.append([path, None])
+            continue
+        distributions = list()
+        try:
+            names = sorted(os.listdir(path or '.'))
+        except OSError:
+            names = list()
+        for name in names:
+            if name.endswith('.dist-info') or name.endswith('.egg-info'):
+                try:
+                    distributions.append([name, os.stat(os.path.join(path, name)).st_mtime])
+                except OSError:
+                    pass
+        key.append([path, distributions])
+    return key
+
+
+def ScanEntryPoints():
+    """ Returns {group: {name: 'module:Class'}} for the entry points of every registry group. """
+    from importlib import metadata
+    groups = [registry.GetGroup() for registry in REGISTRIES]
+    entryPoints = metadata.entry_points()
+    plugins = dict()
+    for group in groups:
+        if hasattr(entryPoints, 'select'):
+            selected = entryPoints.select(group = group)
+        else:
+            selected = entryPoints.get(group, [])
+        plugins[group] = dict((entryPoint.name, entryPoint.value.split('[')[0].strip()) for entryPoint in selected)
+    return plugins
+
+
+def DiscoverPlugins(cacheFilename = DISCOVERY_CACHE, rescan = False):
+    """ Registers the backends of installed plugins, once per process.
+    Built-in backends keep their name when a plugin reuses it.
+    """
+    global _discovered
+    if _discovered and not rescan:
+        return
+    _discovered = True
+    key = GetPathKey()
+    plugins = None
+    if not rescan:
+        try:
+            with open(cacheFilename, 'r') as f:
+                cache = json.load(f)
+            if cache.get('key') == key:
+                plugins = cache['plugins']
+        except (IOError, ValueError, KeyError):
+            pass
+    if plugins is None:
+        plugins = ScanEntryPoints()
+        try:
+            directory = os.path.dirname(cacheFilename)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(cacheFilename, 'w') as f:
+                json.dump({'key': key, 'plugins': plugins}, f)
+        except (IOError, OSError):
+            # A read-only home directory only costs a rescan on the next start
+            pass
+    for registry in REGISTRIES:
+        for name, target in plugins.get(registry.GetGroup(), dict()).items():
+            if not registry.Contains(name):
+                registry.Register(name, target)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Reflow backend registry", usage='%(prog)s [options] [parameter]')
+    parser.add_argument('--rescan', nargs='*', help='ignore the discovery cache and scan installed packages again')
+    args = vars(parser.parse_args())
+
+    DiscoverPlugins(rescan = args['rescan'] is not None)
+    for registry in REGISTRIES:
+        print(registry.GetGroup())
+        for name in registry.ListTypes():
+            print("  " + name)
@@ -0,0 +1,138 @@
+#!/usr/bin/python
+#
+# Time proportioning relay driver
+# Turns the PID output into relay edges from a dedicated thread. Each window starts at an
+# absolute deadline on the clock: the relay goes on at the window start and off once the
+# duty cycle latched at that start has elapsed, so there are at most two relay writes per
+# window and their timing does not depend on what the control loop is doing.
+#
+import threading
+import collections
+from clock import GetDefaultClock
+from relayinterface import RelayInterface
+
+
+class RelayDriver(object):
+    """ Drives a RelayInterface with a duty cycle, in ms of 'on' time per window.
+    Edge timing errors (actual minus scheduled edge time, in seconds) are kept for the last windows.
+    Runs on real time: a VirtualClock would never let the waits complete.
+    """
+    def __init__(self, relay, windowSizeMs = 2000, clock = None, history = 64):
+        if (clock is None):
+            clock = GetDefaultClock()
+        self.__relay = relay
+        self.__clock = clock
+        self.__windowSize = float(windowSizeMs)
+        self.__windowTime = self.__windowSize / 1000.0
+        self.__output = 0.0
+        self.__state = None
+        self.__offRequested = False
+        self.__windowCount = 0
+        self.__edgeErrors = collections.deque(maxlen = history)
+        self.__maxEdgeError = 0.0
+        # Off() against the duty cycle latch and the 'on' edge of the driver thread
+        self.__lock = threading.Lock()
+        self.__wakeEvent = threading.Event()
+        self.__stopEvent = threading.Event()
+        self.__thread = None
+
+    def Start(self):
+        if self.__thread is not None:
+            return
+        self.__stopEvent.clear()
+        self.__thread = threading.Thread(target = self.__Run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def Stop(self):
+        if self.__thread is not None:
+            self.__stopEvent.set()
+            self.__wakeEvent.set()
+            self.__thread.join()
+            self.__thread = None
+        self.__output = 0.0
+        self.__Switch(RelayInterface.OFF, self.__clock.Now())
+
+    def SetOutput(self, outputMs):
+        """ Sets the 'on' time of the next windows, in ms. """
+        self.__output = min(max(outputMs, 0.0), self.__windowSize)
+
+    def Off(self):
+        """ Turns the relay off right away instead of at the end of the current 'on' time. """
+        with self.__lock:
+            self.__output = 0.0
+            # Always flagged: the relay may be switched on right after a check of its state here
+            self.__offRequested = True
+        self.__wakeEvent.set()
+
+    def GetState(self):
+        if self.__state is None:
+            return RelayInterface.OFF
+        return self.__state
+
+    def GetWindowCount(self):
+        return self.__windowCount
+
+    def GetEdgeErrors(self):
+        """ Returns the largest edge timing error of each of the last windows. """
+        return list(self.__edgeErrors)
+
+    def GetLastEdgeError(self):
+        if len(self.__edgeErrors) == 0:
+            return None
+        return self.__edgeErrors[-1]
+
+    def GetMaxEdgeError(self):
+        return self.__maxEdgeError
+
+    def __Run(self):
+        windowStart = self.__clock.Now()
+        while not self.__stopEvent.is_set():
+            windowEnd = windowStart + self.__windowTime
+            errors = list()
+            with self.__lock:
+                # The duty cycle is latched for the whole window, a pending Off() keeps it off
+                onTime = self.__output / 1000.0
+                if self.__offRequested:
+                    self.__offRequested = False
+                    onTime = 0.0
+                    self.__Switch(RelayInterface.OFF, self.__clock.Now())
+                if (onTime > 0.0):
+                    errors.append(self.__Switch(RelayInterface.ON, windowStart))
+            if (onTime < self.__windowTime):
+                if self.__WaitUntil(windowStart + onTime):
+                    break
+                errors.append(self.__Switch(RelayInterface.OFF, windowStart + onTime))
+            if self.__WaitUntil(windowEnd):
+                break
+            errors = [abs(error) for error in errors if error is not None]
+            if len(errors) > 0:
+                self.__edgeErrors.append(max(errors))
+                self.__maxEdgeError = max(self.__maxEdgeError, max(errors))
+            self.__windowCount += 1
+            windowStart = windowEnd
+            if (self.__clock.Now() - windowStart) > self.__windowTime:
+                # Fell more than a window behind (e.g. the system was suspended): start over from now
+                windowStart = self.__clock.Now()
+
+    def __WaitUntil(self, deadline):
+        # Returns True when the driver is stopping
+        while True:
+            if self.__stopEvent.is_set():
+                return True
+            if self.__offRequested:
+                self.__offRequested = False
+                self.__Switch(RelayInterface.OFF, self.__clock.Now())
+            remaining = deadline - self.__clock.Now()
+            if (remaining <= 0.0):
+                return False
+            self.__wakeEvent.wait(remaining)
+            self.__wakeEvent.clear()
+
+    def __Switch(self, state, edgeTime):
+        # Only edges reach the relay, returns the edge timing error
+        if (state == self.__state):
+            return None
+        self.__relay.SwitchRelay(state)
+        self.__state = state
+        return self.__clock.Now() - edgeTime
@@ -1,18 +1,14 @@
 #!/usr/bin/python
 from id import *
-
-_plat = PlatformID()
-if (_plat.IsLinux() and _plat.IsARM()):
-    from mcp23008 import MCP23008, MCP23008PinState
-    from i2c import I2CDevice
-    import RPi.GPIO as GPIO
+from simulator import GetOvenModel
+from registry import RELAY_INTERFACES
 
 
 class RelayInterface(object):
     ON = 1
     OFF = 0
     def __init__(self, kwargs):
-        self._plat = PlatformID()
+        self._plat = GetPlatformID()
         self._kwargs = kwargs
         self._pin = int(kwargs['pin'])
         
@@ -26,18 +22,21 @@ class RelayInterface(object):
 class RPI(RelayInterface):        
     def __init__(self, kwargs):
         super(RPI, self).__init__(kwargs)
+        self.__GPIO = None
         if (self._plat.IsLinux() and self._plat.IsARM()):
+            import RPi.GPIO as GPIO
+            self.__GPIO = GPIO
             GPIO.setwarnings(False)
             GPIO.setmode(GPIO.BCM)
             GPIO.setup(self._kwargs['pin'], GPIO.OUT)
 
     def SwitchRelay(self, state):
-        if (self._plat.IsLinux() and self._plat.IsARM()):
-            GPIO.output(self._pin, state)
+        if (self.__GPIO is not None):
+            self.__GPIO.output(self._pin, state)
     
     def Cleanup(self):
-        if (self._plat.IsLinux() and self._plat.IsARM()):
-            GPIO.GPIO.cleanup()
+        if (self.__GPIO is not None):
+            self.__GPIO.cleanup()
 
 
 class MCP23008IO(RelayInterface):
@@ -45,43 +44,103 @@ class MCP23008IO(RelayInterface):
         self.__IO = None
         super(MCP23008IO, self).__init__(kwargs)
         if (self._plat.IsLinux() and self._plat.IsARM()):
-            _i2c = I2CDevice(int(kwargs['i2cbus']), int(kwargs['i2caddr']))
+            from mcp23008 import MCP23008, MCP23008PinState
+            from i2c import I2CDevice, CachedI2CDevice
+            self.__PinState = MCP23008PinState
+            # The expander powers up in sequential mode
+            _i2c = CachedI2CDevice(I2CDevice(int(kwargs['i2cbus']), int(kwargs['i2caddr'])), sequential = True)
             self.__IO = MCP23008(_i2c)
             self.__IO.PinMode(self._pin)
-            self.__IO.SetOutputState(self._pin, MCP23008PinState.Low)
+            self.__IO.SetOutputState(self._pin, self.__PinState.Low)
+
+    def GetExpander(self):
+        # Lets the other expander pins serve as inputs, e.g. for the door interlock
+        return self.__IO
             
     def SwitchRelay(self, state):
-        if (self._plat.IsLinux() and self._plat.IsARM()):
+        if (self.__IO is not None):
             if (state == RelayInterface.ON):
-                self.__IO.SetOutputState(self._pin, MCP23008PinState.High)
+                self.__IO.SetOutputState(self._pin, self.__PinState.High)
             else:
-                self.__IO.SetOutputState(self._pin, MCP23008PinState.Low)
+                self.__IO.SetOutputState(self._pin, self.__PinState.Low)
 
     def Cleanup(self):
-        if (self._plat.IsLinux() and self._plat.IsARM()):
-            self.__IO.SetOutputState(self._pin, MCP23008PinState.Low)
+        if (self.__IO is not None):
+            self.__IO.SetOutputState(self._pin, self.__PinState.Low)
     
+
+
+class MCP23008RelayBank(object):
+    """ Shares one MCP23008 between the relays of several ovens.
+    Relays only update the pending port state, Flush() pushes all of them with a single register write.
+    """
+    def __init__(self, mcp):
+        self.__IO = mcp
+        self.__mask = 0x00
+        self.__pending = 0x00
+        self.__written = None
+
+    def AddPin(self, pin):
+        self.__IO.PinMode(pin)
+        self.__mask |= (1 << pin)
+        self.__pending &= ~(1 << pin)
+        self.__written = None
+
+    def SetPin(self, pin, state):
+        if (state == RelayInterface.ON):
+            self.__pending |= (1 << pin)
+        else:
+            self.__pending &= ~(1 << pin)
+
+    def Flush(self):
+        if (self.__pending != self.__written):
+            self.__IO.SetOutputPort(self.__mask, self.__pending)
+            self.__written = self.__pending
+
+
+class MCP23008BankRelay(RelayInterface):
+    """ Relay on a pin of a shared MCP23008RelayBank, passed in kwargs['bank'].
+    Not in RELAY_INTERFACES: only the multi-oven controllers, which open the bank, create it.
+    """
+    def __init__(self, kwargs):
+        super(MCP23008BankRelay, self).__init__(kwargs)
+        self.__bank = kwargs.get('bank')
+        if self.__bank is None:
+            raise Exception("MCP23008BankRelay needs a shared MCP23008RelayBank, see multioven.OpenRelayBank()")
+        self.__bank.AddPin(self._pin)
+
+    def SwitchRelay(self, state):
+        self.__bank.SetPin(self._pin, state)
+
+    def Cleanup(self):
+        self.__bank.SetPin(self._pin, RelayInterface.OFF)
+        self.__bank.Flush()
+
+
+class SimulatedOven(RelayInterface):
+    def __init__(self, kwargs):
+        # The simulated heater is not wired to a pin
+        kwargs = dict(kwargs or {})
+        kwargs.setdefault('pin', 0)
+        super(SimulatedOven, self).__init__(kwargs)
+        self.__model = GetOvenModel(kwargs)
+
+    def SwitchRelay(self, state):
+        self.__model.SetHeater(state == RelayInterface.ON)
+
+    def Cleanup(self):
+        self.__model.SetHeater(False)
+
     
 class RelayInterfaceFactory(object):
     def __init__(self):
         pass
 
     def GetInstance(self, Type, kwargs):
-        types = self.ListTypes()
-        if types.__contains__(Type):
-            module = __import__(__name__)
-            _class = getattr(module, Type)
-            return _class(kwargs)
-        else:
-            raise Exception("Unsupported relay interface")
+        return RELAY_INTERFACES.GetInstance(Type, kwargs)
 
     def ListTypes(self):
-        types = list()
-        for _class in RelayInterface.__subclasses__():
-            classInfo = str(_class).split('.')
-            strippedClass = classInfo[1].strip('\'>')
-            types.append(strippedClass)
-        return types
+        return RELAY_INTERFACES.ListTypes()
 
 
 if __name__ == '__main__':
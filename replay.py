@@ -0,0 +1,147 @@
+#!/usr/bin/python
+#
+# Reflow run replay
+# Re-drives ReflowStateMachine and PID from the temperature trace of a recorded run log,
+# on virtual time, and compares the resulting decisions with the original run.
+#
+import argparse
+import numpy as np
+from clock import VirtualClock
+from thermocouple import Thermocouple
+from relayinterface import RelayInterface
+from reflowctl import ReflowStateMachine, ReflowState
+from runlog import RunLogReader, GetRecordDType
+from gains import LoadGainTable
+
+
+class TraceThermocouple(Thermocouple):
+    """ Plays back a recorded temperature trace: kwargs 'times', 'temperatures' and 'clock'. """
+    def __init__(self, kwargs):
+        super(TraceThermocouple, self).__init__(kwargs)
+        self.__times = kwargs['times']
+        self.__temperatures = kwargs['temperatures']
+        self.__clock = kwargs['clock']
+        self.__end = self.__times[-1] + (ReflowStateMachine.SENSOR_SAMPLING_TIME / 1000.0)
+
+    def ReadCelsius(self):
+        now = self.__clock.Now()
+        if now > self.__end:
+            raise Exception("End of temperature trace")
+        index = int(np.searchsorted(self.__times, now, side='right')) - 1
+        return float(self.__temperatures[max(index, 0)])
+
+
+class CaptureRelay(RelayInterface):
+    """ Records relay edges against a clock instead of switching anything. """
+    def __init__(self, kwargs):
+        kwargs = dict(kwargs or {})
+        kwargs.setdefault('pin', 0)
+        super(CaptureRelay, self).__init__(kwargs)
+        self.__clock = kwargs['clock']
+        self.__state = None
+        self.Edges = list()
+
+    def SwitchRelay(self, state):
+        if state != self.__state:
+            self.__state = state
+            self.Edges.append((self.__clock.Now(), state))
+
+    def Cleanup(self):
+        pass
+
+
+class CaptureRecorder(object):
+    """ In-memory stand-in for runlog.RunRecorder. """
+    def __init__(self):
+        self.__records = list()
+
+    def Record(self, timestamp, state, relay, _input, setpoint, output, Kp, Ki, Kd):
+        self.__records.append((timestamp, state, relay, _input, setpoint, output, Kp, Ki, Kd))
+
+    def GetRecords(self):
+        return np.array(self.__records, dtype = GetRecordDType())
+
+
+def ExtractEvents(records):
+    """ Returns the (time since start, kind, value) state transitions, tuning changes and relay edges of a run.
+    Tunings are compared by value, so a SetTunings() call that keeps the same gains is not an event.
+    """
+    events = list()
+    if len(records) == 0:
+        return events
+    start = records['timestamp'][0]
+    for kind, columns in (('state', ('state',)), ('tunings', ('kp', 'ki', 'kd')), ('relay', ('relay',))):
+        changed = np.zeros(len(records), dtype = bool)
+        changed[0] = True
+        for column in columns:
+            changed[1:] |= (records[column][1:] != records[column][:-1])
+        for index in np.flatnonzero(changed):
+            value = tuple(records[column][index].item() for column in columns)
+            if len(value) == 1:
+                value = value[0]
+            events.append((records['timestamp'][index] - start, kind, value))
+    events.sort(key = lambda event: event[0])
+    return events
+
+
+def DiffEvents(original, replayed, tolerance = 1.0):
+    """ Pairs events of the same kind in order and reports the ones that differ in value or by more than tolerance seconds. """
+    differences = list()
+    for kind in ('state', 'tunings', 'relay'):
+        a = [event for event in original if event[1] == kind]
+        b = [event for event in replayed if event[1] == kind]
+        for index in range(max(len(a), len(b))):
+            if index >= len(a):
+                differences.append("+ %s %s at %.1fs (replay only)" % (kind, b[index][2], b[index][0]))
+            elif index >= len(b):
+                differences.append("- %s %s at %.1fs (original only)" % (kind, a[index][2], a[index][0]))
+            elif (a[index][2] != b[index][2]) or (abs(a[index][0] - b[index][0]) > tolerance):
+                differences.append("! %s %s at %.1fs, replay %s at %.1fs" % (kind, a[index][2], a[index][0], b[index][2], b[index][0]))
+    return differences
+
+
+def Replay(records, reflowProfile, gainTable = None):
+    """ Re-runs a recorded cycle and returns the replayed records and relay edges. """
+    times = records['timestamp']
+    clock = VirtualClock(times[0])
+    kwargs = {'times': times, 'temperatures': records['input'], 'clock': clock}
+    thermocouple = TraceThermocouple(kwargs)
+    relay = CaptureRelay(kwargs)
+    recorder = CaptureRecorder()
+    reflowCtl = ReflowStateMachine(reflowProfile, thermocouple, relay, clock = clock, gainTable = gainTable, recorder = recorder)
+    reflowCtl.Reflow()
+    return recorder.GetRecords(), relay.Edges
+
+
+def FormatEvent(event):
+    elapsed, kind, value = event
+    if kind == 'state':
+        value = ReflowState.Messages[value]
+    return "%8.1fs %-8s %s" % (elapsed, kind, value)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Reflow run replay", usage='%(prog)s [options] [parameter]')
+    parser.add_argument('runlogs', nargs='+', type=str, help='run log files to replay')
+    parser.add_argument('--profile', nargs=1, type=str, required=True, help='profile name or file used for the original runs')
+    parser.add_argument('--gains', nargs=1, type=str, help='per-oven PID gain table used for the original runs')
+    parser.add_argument('--verbose', nargs='*', help='print every replayed event')
+    args = vars(parser.parse_args())
+
+    gainTable = None
+    if args['gains'] is not None:
+        gainTable = LoadGainTable(args['gains'][0])
+    for filename in args['runlogs']:
+        reader = RunLogReader(filename)
+        original = reader.GetRecords()
+        replayed, edges = Replay(original, args['profile'][0], gainTable)
+        replayedEvents = ExtractEvents(replayed)
+        differences = DiffEvents(ExtractEvents(original), replayedEvents)
+        print(filename + ": " + str(len(replayedEvents)) + " events, " + str(len(differences)) + " differences")
+        if args['verbose'] is not None:
+            for event in replayedEvents:
+                print(FormatEvent(event))
+        for difference in differences:
+            print(difference)
+        original = None
+        reader.Close()
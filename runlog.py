@@ -0,0 +1,147 @@
+#!/usr/bin/python
+#
+# Compact binary run log
+# Fixed-width records are packed into an in-memory block and handed over to a writer
+# thread once the block is full, so recording never blocks the control loop.
+# The file is preallocated and grown in chunks; the header keeps the record count.
+#
+import mmap
+import struct
+import argparse
+import threading
+import queue
+
+
+RUNLOG_MAGIC = b'RFLOWLOG'
+RUNLOG_VERSION = 1
+# magic, version, record size, capacity, record count
+HEADER_FORMAT = '<8sIIQQ'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+# timestamp, state, relay, input, setpoint, output, Kp, Ki, Kd
+RECORD_FORMAT = '<dBBdddddd'
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+RECORD_FIELDS = ('timestamp', 'state', 'relay', 'input', 'setpoint', 'output', 'kp', 'ki', 'kd')
+
+
+def GetRecordDType():
+    import numpy as np
+    return np.dtype([
+        ('timestamp', '<f8'),
+        ('state', 'u1'),
+        ('relay', 'u1'),
+        ('input', '<f8'),
+        ('setpoint', '<f8'),
+        ('output', '<f8'),
+        ('kp', '<f8'),
+        ('ki', '<f8'),
+        ('kd', '<f8')])
+
+
+class RunRecorder(object):
+    def __init__(self, filename, capacity = 65536, blockRecords = 256):
+        self.__filename = filename
+        self.__capacity = capacity
+        self.__blockRecords = blockRecords
+        self.__block = bytearray(RECORD_SIZE * blockRecords)
+        self.__blockCount = 0
+        self.__count = 0
+        self.__queue = queue.Queue()
+        self.__file = open(filename, 'w+b')
+        self.__allocated = 0
+        self.__Allocate(capacity)
+        self.__thread = threading.Thread(target = self.__Writer)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def Record(self, timestamp, state, relay, _input, setpoint, output, Kp, Ki, Kd):
+        struct.pack_into(RECORD_FORMAT, self.__block, self.__blockCount * RECORD_SIZE,
+                         timestamp, state, relay, _input, setpoint, output, Kp, Ki, Kd)
+        self.__blockCount += 1
+        if self.__blockCount == self.__blockRecords:
+            self.Flush()
+
+    def Flush(self):
+        if self.__blockCount == 0:
+            return
+        data = bytes(self.__block[:self.__blockCount * RECORD_SIZE])
+        self.__queue.put((self.__count, self.__blockCount, data))
+        self.__count += self.__blockCount
+        self.__blockCount = 0
+
+    def GetCount(self):
+        return self.__count + self.__blockCount
+
+    def Close(self):
+        self.Flush()
+        self.__queue.put(None)
+        self.__thread.join()
+        # Give back the preallocated space: a closed log is only as large as its records
+        self.__file.truncate(HEADER_SIZE + (self.__count * RECORD_SIZE))
+        self.__allocated = self.__count
+        self.__WriteHeader(self.__count)
+        self.__file.close()
+
+    def __Allocate(self, capacity):
+        self.__file.truncate(HEADER_SIZE + (capacity * RECORD_SIZE))
+        self.__allocated = capacity
+        self.__WriteHeader(self.__count)
+
+    def __WriteHeader(self, count):
+        self.__file.seek(0)
+        self.__file.write(struct.pack(HEADER_FORMAT, RUNLOG_MAGIC, RUNLOG_VERSION, RECORD_SIZE, self.__allocated, count))
+
+    def __Writer(self):
+        while True:
+            block = self.__queue.get()
+            if block is None:
+                break
+            first, count, data = block
+            if (first + count) > self.__allocated:
+                self.__Allocate(self.__allocated + self.__capacity)
+            self.__file.seek(HEADER_SIZE + (first * RECORD_SIZE))
+            self.__file.write(data)
+            # The header is updated last so that readers never see a partially written block
+            self.__WriteHeader(first + count)
+            self.__file.flush()
+
+
+class RunLogReader(object):
+    """ Memory-maps a run log and exposes its records as a NumPy structured array, without copying.
+    Drop all the arrays obtained from the reader before calling Close().
+    """
+    def __init__(self, filename):
+        import numpy as np
+        self.__file = open(filename, 'rb')
+        self.__mmap = mmap.mmap(self.__file.fileno(), 0, access = mmap.ACCESS_READ)
+        magic, version, recordSize, capacity, count = struct.unpack_from(HEADER_FORMAT, self.__mmap, 0)
+        if (magic != RUNLOG_MAGIC):
+            raise Exception("Not a run log: " + filename)
+        if (version != RUNLOG_VERSION or recordSize != RECORD_SIZE):
+            raise Exception("Unsupported run log version " + str(version))
+        self.__records = np.frombuffer(self.__mmap, dtype = GetRecordDType(), count = count, offset = HEADER_SIZE)
+
+    def GetRecords(self):
+        return self.__records
+
+    def GetColumn(self, name):
+        return self.__records[name]
+
+    def GetCount(self):
+        return len(self.__records)
+
+    def Close(self):
+        self.__records = None
+        self.__mmap.close()
+        self.__file.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run log dump", usage='%(prog)s [options] [parameter]')
+    parser.add_argument('runlog', nargs=1, type=str, help='run log file')
+    args = vars(parser.parse_args())
+    reader = RunLogReader(args['runlog'][0])
+    print(" ".join(RECORD_FIELDS))
+    for record in reader.GetRecords():
+        print(" ".join(str(value) for value in record.tolist()))
+    record = None
+    reader.Close()
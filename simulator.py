@@ -0,0 +1,97 @@
+#!/usr/bin/python
+#
+# Simulated reflow oven
+# Lumped thermal-mass model of a toaster oven, driven by the SimulatedOven relay
+# and read back by the SimulatedOven thermocouple, so that the controller can run
+# end to end without any hardware attached.
+#
+import time
+import threading
+from clock import GetDefaultClock
+
+
+class OvenModel(object):
+    # Default model parameters, each of them can be overridden through kwargs
+    AMBIENT_TEMPERATURE = 25.0  # C
+    HEATER_POWER = 1500.0       # W
+    LOSS_COEFFICIENT = 2.5      # W/C lost to the ambient air
+    THERMAL_MASS = 800.0        # J/C
+    SENSOR_LAG = 10.0           # s, first order lag of the thermocouple
+    INTEGRATION_STEP = 0.1      # s
+
+    def __init__(self, kwargs = None):
+        if kwargs is None:
+            kwargs = dict()
+        self.__ambient = float(kwargs.get('simambient', self.AMBIENT_TEMPERATURE))
+        self.__power = float(kwargs.get('simpower', self.HEATER_POWER))
+        self.__loss = float(kwargs.get('simloss', self.LOSS_COEFFICIENT))
+        self.__mass = float(kwargs.get('simmass', self.THERMAL_MASS))
+        self.__lag = float(kwargs.get('simlag', self.SENSOR_LAG))
+        start = float(kwargs.get('simstart', self.__ambient))
+        self.__ovenTemperature = start
+        self.__sensorTemperature = start
+        self.__heaterOn = False
+        self.__lock = threading.Lock()
+        self.__clock = kwargs.get('clock') or GetDefaultClock()
+        self.__lastUpdate = self.__clock.Now()
+
+    def SetHeater(self, on):
+        with self.__lock:
+            self.__Update()
+            self.__heaterOn = bool(on)
+
+    def IsHeaterOn(self):
+        return self.__heaterOn
+
+    def GetOvenCelsius(self):
+        with self.__lock:
+            self.__Update()
+            return self.__ovenTemperature
+
+    def GetSensorCelsius(self):
+        with self.__lock:
+            self.__Update()
+            return self.__sensorTemperature
+
+    def __Update(self):
+        now = self.__clock.Now()
+        elapsed = now - self.__lastUpdate
+        self.__lastUpdate = now
+        heat = self.__power if self.__heaterOn else 0.0
+        while elapsed > 0.0:
+            dt = min(elapsed, self.INTEGRATION_STEP)
+            elapsed -= dt
+            loss = self.__loss * (self.__ovenTemperature - self.__ambient)
+            self.__ovenTemperature += (heat - loss) * dt / self.__mass
+            self.__sensorTemperature += (self.__ovenTemperature - self.__sensorTemperature) * dt / (self.__lag + dt)
+
+
+_models = dict()
+_modelsLock = threading.Lock()
+
+def GetOvenModel(kwargs = None):
+    """ Returns the model shared by the SimulatedOven relay and thermocouple.
+    Models are keyed by the optional 'simoven' kwarg so several simulated ovens can coexist.
+    A model asked for again with another clock or other model parameters is rebuilt from them.
+    """
+    if kwargs is None:
+        kwargs = dict()
+    name = kwargs.get('simoven')
+    config = (kwargs.get('clock') or GetDefaultClock(),
+              tuple(kwargs.get(k) for k in ('simambient', 'simpower', 'simloss', 'simmass', 'simlag', 'simstart')))
+    with _modelsLock:
+        entry = _models.get(name)
+        if entry is None or entry[0] is not config[0] or entry[1] != config[1]:
+            entry = (config[0], config[1], OvenModel(kwargs))
+            _models[name] = entry
+        return entry[2]
+
+if __name__ == '__main__':
+    model = OvenModel()
+    model.SetHeater(True)
+    try:
+        while True:
+            time.sleep(1)
+            print("Oven: %.1fC Sensor: %.1fC" % (model.GetOvenCelsius(), model.GetSensorCelsius()))
+    except KeyboardInterrupt:
+        pass
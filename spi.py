@@ -0,0 +1,53 @@
+#!/usr/bin/python
+import time
+
+
+class SPIDevice:
+    def __init__(self, SPIBus, SPIDevice, SpeedHz = 4000000, Mode = 0):
+        import spidev
+        self.__spi = spidev.SpiDev()
+        self.__spi.open(SPIBus, SPIDevice)
+        self.__spi.max_speed_hz = SpeedHz
+        self.__spi.mode = Mode
+
+    def ReadBytes(self, count):
+        return self.__spi.xfer2([0] * count)
+
+    def WriteBytes(self, dataBytes):
+        self.__spi.writebytes(list(dataBytes))
+
+    def Close(self):
+        self.__spi.close()
+
+
+class FakeSPIDevice:
+    """ Replays frames from a text file, one frame of hex bytes per line ('#' starts a comment),
+    cycling back to the first frame at the end. The time of each read is kept for timing tests.
+    """
+    def __init__(self, filename, clock = None):
+        self.__frames = list()
+        with open(filename, 'r') as f:
+            for line in f:
+                line = line.split('#')[0].strip()
+                if len(line) > 0:
+                    self.__frames.append(list(bytearray.fromhex(line)))
+        if len(self.__frames) == 0:
+            raise Exception("No SPI frames in " + filename)
+        self.__index = 0
+        self.__clock = clock
+        self.ReadTimes = list()
+
+    def ReadBytes(self, count):
+        frame = self.__frames[self.__index]
+        self.__index = (self.__index + 1) % len(self.__frames)
+        if self.__clock is not None:
+            self.ReadTimes.append(self.__clock.Now())
+        else:
+            self.ReadTimes.append(time.monotonic())
+        return (frame + [0] * count)[:count]
+
+    def WriteBytes(self, dataBytes):
+        pass
+
+    def Close(self):
+        pass
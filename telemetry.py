@@ -0,0 +1,225 @@
+#!/usr/bin/python
+#
+# Live telemetry
+# TelemetryPublisher sits in the recorder slot of ReflowStateMachine. The control loop pays
+# for one queue put per sample; a dispatcher thread encodes each event to JSON once and fans
+# it out to the subscribers. A subscriber that falls behind loses its oldest events instead of
+# slowing anyone else down.
+# TelemetryServer streams the same events to any number of viewers as HTTP Server-Sent Events.
+#
+import json
+import queue
+import threading
+import http.server
+from reflowctl import ReflowState
+
+
+class TelemetrySubscription(object):
+    def __init__(self, publisher, depth):
+        self.__publisher = publisher
+        self.__queue = queue.Queue(maxsize = depth)
+        self.Dropped = 0
+
+    def Get(self, timeout = None):
+        """ Returns the next event as a JSON string, None once closed, or raises queue.Empty on timeout. """
+        return self.__queue.get(timeout = timeout)
+
+    def Put(self, line):
+        while True:
+            try:
+                self.__queue.put_nowait(line)
+                return
+            except queue.Full:
+                try:
+                    self.__queue.get_nowait()
+                    self.Dropped += 1
+                except queue.Empty:
+                    pass
+
+    def Close(self):
+        self.__publisher.Unsubscribe(self)
+
+
+class TelemetryPublisher(object):
+    """ Publishes one 'sample' event per period (and on every state change) from the Record() calls
+    of the control loop, plus any event given to Publish(). A RunRecorder can be chained behind it.
+    """
+    def __init__(self, period = 1.0, recorder = None, depth = 256):
+        self.__period = period
+        self.__recorder = recorder
+        self.__depth = depth
+        self.__nextSample = 0.0
+        self.__lastState = None
+        self.__latest = None
+        self.__inbound = queue.Queue()
+        self.__subscribers = list()
+        self.__lock = threading.Lock()
+        self.__thread = None
+
+    def SetRecorder(self, recorder):
+        self.__recorder = recorder
+
+    def Start(self):
+        if self.__thread is not None:
+            return
+        self.__thread = threading.Thread(target = self.__Dispatch)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def Stop(self):
+        if self.__thread is None:
+            return
+        self.__inbound.put(None)
+        self.__thread.join()
+        self.__thread = None
+        with self.__lock:
+            subscribers = list(self.__subscribers)
+            self.__subscribers = list()
+        for subscriber in subscribers:
+            subscriber.Put(None)
+
+    def Record(self, timestamp, state, relay, _input, setpoint, output, Kp, Ki, Kd):
+        if (self.__recorder is not None):
+            self.__recorder.Record(timestamp, state, relay, _input, setpoint, output, Kp, Ki, Kd)
+        if (state == self.__lastState and timestamp < self.__nextSample):
+            return
+        self.__nextSample = timestamp + self.__period
+        self.__lastState = state
+        self.__inbound.put(('sample', (timestamp, state, relay, _input, setpoint, output)))
+
+    def Publish(self, event, **fields):
+        fields['event'] = event
+        self.__inbound.put((None, fields))
+
+    def GetLatest(self):
+        """ Returns the newest sample as a dict, or None. """
+        return self.__latest
+
+    def Subscribe(self, depth = None):
+        subscription = TelemetrySubscription(self, depth or self.__depth)
+        with self.__lock:
+            self.__subscribers.append(subscription)
+        return subscription
+
+    def Unsubscribe(self, subscription):
+        with self.__lock:
+            if subscription in self.__subscribers:
+                self.__subscribers.remove(subscription)
+
+    def GetSubscriberCount(self):
+        with self.__lock:
+            return len(self.__subscribers)
+
+    def __Dispatch(self):
+        while True:
+            item = self.__inbound.get()
+            if item is None:
+                return
+            kind, values = item
+            if kind == 'sample':
+                timestamp, state, relay, _input, setpoint, output = values
+                event = {
+                    'event': 'sample',
+                    'time': timestamp,
+                    'state': state,
+                    'stateName': ReflowState.Messages[state],
+                    'relay': relay,
+                    'temperature': _input,
+                    'setpoint': setpoint,
+                    'output': output}
+                self.__latest = event
+            else:
+                event = values
+            line = json.dumps(event)
+            with self.__lock:
+                subscribers = list(self.__subscribers)
+            for subscriber in subscribers:
+                subscriber.Put(line)
+
+
+class TelemetryRequestHandler(http.server.BaseHTTPRequestHandler):
+    # GET /events streams Server-Sent Events, GET /status returns the latest sample
+    KEEPALIVE_TIME = 15.0
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/events':
+            self.__Events()
+        elif path == '/status':
+            body = json.dumps(self.server.Publisher.GetLatest()).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_error(404)
+
+    def log_message(self, format, *args):
+        pass
+
+    def __Events(self):
+        subscription = self.server.Publisher.Subscribe()
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            latest = self.server.Publisher.GetLatest()
+            if latest is not None:
+                self.__Send('data: ' + json.dumps(latest) + '\n\n')
+            idle = 0.0
+            while not self.server.Stopping.is_set():
+                try:
+                    line = subscription.Get(timeout = 1.0)
+                except queue.Empty:
+                    # Comments keep proxies from closing the stream and detect dead clients
+                    idle += 1.0
+                    if idle >= self.KEEPALIVE_TIME:
+                        idle = 0.0
+                        self.__Send(': keepalive\n\n')
+                    continue
+                if line is None:
+                    return
+                idle = 0.0
+                self.__Send('data: ' + line + '\n\n')
+        except (IOError, OSError):
+            # Viewer went away
+            pass
+        finally:
+            subscription.Close()
+
+    def __Send(self, text):
+        self.wfile.write(text.encode('utf-8'))
+        self.wfile.flush()
+
+
+class TelemetryServer(object):
+    """ HTTP server streaming the events of a TelemetryPublisher from its own thread.
+    port 0 picks a free port, see GetPort().
+    """
+    def __init__(self, publisher, port, host = '127.0.0.1'):
+        self.__server = http.server.ThreadingHTTPServer((host, port), TelemetryRequestHandler)
+        self.__server.daemon_threads = True
+        self.__server.Publisher = publisher
+        self.__server.Stopping = threading.Event()
+        self.__thread = None
+
+    def GetPort(self):
+        return self.__server.server_address[1]
+
+    def Start(self):
+        if self.__thread is not None:
+            return
+        self.__thread = threading.Thread(target = self.__server.serve_forever)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def Stop(self):
+        if self.__thread is None:
+            return
+        self.__server.Stopping.set()
+        self.__server.shutdown()
+        self.__thread.join()
+        self.__thread = None
+        self.__server.server_close()
@@ -1,6 +1,9 @@
 #!/usr/bin/python
-
-from onewire import OneWireFactory
+import threading
+import collections
+from simulator import GetOvenModel
+from clock import GetDefaultClock
+from registry import THERMOCOUPLES
 
 class Thermocouple(object):
     def __init__(self, kwargs):
@@ -13,11 +16,193 @@ class Thermocouple(object):
 class Max31850(Thermocouple):
     def __init__(self, kwargs):
         super(Max31850, self).__init__(kwargs)
-        self.__OneWireFactory = OneWireFactory('reflow.cfg')
+        alias = 'oven'
+        if kwargs is not None and 'alias' in kwargs:
+            alias = kwargs['alias']
+        from onewire import OneWireFactory
+        self.__session = OneWireFactory('reflow.cfg').OpenSession(alias)
     
     def ReadCelsius(self):
-        temps = self.__OneWireFactory.Query()
-        return temps['oven']
+        return self.__session.ReadCelsius()
+
+
+class SimulatedOven(Thermocouple):
+    def __init__(self, kwargs):
+        super(SimulatedOven, self).__init__(kwargs)
+        self.__model = GetOvenModel(kwargs)
+
+    def ReadCelsius(self):
+        return self.__model.GetSensorCelsius()
+
+
+class SPIThermocouple(Thermocouple):
+    """ Base of the SPI thermocouple amplifiers.
+    kwargs 'spibus' and 'spidevice' select the SPI device, or 'spifile' replays frames from a file through
+    spi.FakeSPIDevice. ReadCelsius() averages 'oversample' back-to-back conversions.
+    """
+    FRAME_SIZE = 4
+    CONVERSION_TIME = 0.1
+    SPEED_HZ = 4000000
+
+    def __init__(self, kwargs):
+        super(SPIThermocouple, self).__init__(kwargs)
+        if kwargs is None:
+            kwargs = dict()
+        self.__clock = kwargs.get('clock') or GetDefaultClock()
+        self.__oversample = max(1, int(kwargs.get('oversample') or 1))
+        if kwargs.get('spifile') is not None:
+            from spi import FakeSPIDevice
+            self.__device = FakeSPIDevice(kwargs['spifile'], self.__clock)
+        else:
+            from spi import SPIDevice
+            self.__device = SPIDevice(int(kwargs.get('spibus') or 0), int(kwargs.get('spidevice') or 0), self.SPEED_HZ)
+        self.__lastRead = None
+        self.Faults = 0
+
+    def GetDevice(self):
+        return self.__device
+
+    def ReadFrame(self):
+        # Reading before the end of a conversion would return the previous one again
+        if self.__lastRead is not None:
+            self.__clock.SleepUntil(self.__lastRead + self.CONVERSION_TIME)
+        frame = 0
+        for b in self.__device.ReadBytes(self.FRAME_SIZE):
+            frame = (frame << 8) | b
+        self.__lastRead = self.__clock.Now()
+        return frame
+
+    def ReadBurst(self, count):
+        """ Reads count conversions back to back and returns their temperatures. """
+        samples = list()
+        for index in range(count):
+            frame = self.ReadFrame()
+            fault = self.GetFault(frame)
+            if fault is not None:
+                self.Faults += 1
+                raise Exception("Thermocouple fault: " + fault)
+            samples.append(self.DecodeCelsius(frame))
+        return samples
+
+    def ReadCelsius(self):
+        samples = self.ReadBurst(self.__oversample)
+        return sum(samples) / len(samples)
+
+    def GetFault(self, frame):
+        return None
+
+    def DecodeCelsius(self, frame):
+        raise Exception("Not implemented")
+
+
+class Max31855(SPIThermocouple):
+    # 14-bit thermocouple and 12-bit cold junction temperatures, fault flags, 32-bit frame
+    FRAME_SIZE = 4
+    CONVERSION_TIME = 0.1
+
+    def GetFault(self, frame):
+        if (frame & 0x00010000):
+            if (frame & 0x01):
+                return "open circuit!"
+            elif (frame & 0x02):
+                return "short to GND!"
+            elif (frame & 0x04):
+                return "short to VCC!"
+            return "unknown fault!"
+        return None
+
+    def DecodeCelsius(self, frame):
+        raw = frame >> 18
+        if (raw & 0x2000):
+            raw -= 0x4000
+        return raw * 0.25
+
+    def DecodeInternalCelsius(self, frame):
+        raw = (frame >> 4) & 0xFFF
+        if (raw & 0x800):
+            raw -= 0x1000
+        return raw * 0.0625
+
+
+class Max6675(SPIThermocouple):
+    # 12-bit thermocouple temperature and open circuit flag, 16-bit frame
+    FRAME_SIZE = 2
+    CONVERSION_TIME = 0.22
+
+    def GetFault(self, frame):
+        if (frame & 0x04):
+            return "open circuit!"
+        return None
+
+    def DecodeCelsius(self, frame):
+        return ((frame >> 3) & 0xFFF) * 0.25
+
+
+class ThermocoupleSampler(object):
+    """ Reads a thermocouple from a dedicated thread on its own cadence.
+    Timestamped samples are published into a small ring buffer so that the control loop
+    only picks up the newest value and its age instead of blocking on the conversion.
+    """
+    def __init__(self, thermocouple, samplingPeriodMs = 1000, depth = 8, clock = None):
+        if (clock is None):
+            clock = GetDefaultClock()
+        self.__clock = clock
+        self.__thermocouple = thermocouple
+        self.__samplingPeriod = samplingPeriodMs / 1000.0
+        self.__samples = collections.deque(maxlen = depth)
+        self.__lock = threading.Lock()
+        self.__stopEvent = threading.Event()
+        self.__thread = None
+        self.__lastError = None
+
+    def Start(self):
+        if self.__thread is not None:
+            return
+        self.__stopEvent.clear()
+        # Take a first sample so that readers always find a value once started
+        nextRead = self.__clock.Now()
+        self.__Sample()
+        self.__thread = threading.Thread(target = self.__Run, args = (nextRead + self.__samplingPeriod,))
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def Stop(self):
+        if self.__thread is None:
+            return
+        self.__stopEvent.set()
+        self.__thread.join()
+        self.__thread = None
+
+    def GetLatest(self):
+        """ Returns the newest (timestamp, celsius) sample, or None if no read succeeded yet. """
+        with self.__lock:
+            if len(self.__samples) == 0:
+                return None
+            return self.__samples[-1]
+
+    def GetSamples(self):
+        with self.__lock:
+            return list(self.__samples)
+
+    def GetLastError(self):
+        """ Returns the exception raised by the last read, or None if it succeeded. """
+        return self.__lastError
+
+    def __Sample(self):
+        try:
+            celsius = self.__thermocouple.ReadCelsius()
+        except Exception as e:
+            self.__lastError = e
+            return
+        sample = (self.__clock.Now(), celsius)
+        with self.__lock:
+            self.__samples.append(sample)
+        self.__lastError = None
+
+    def __Run(self, nextRead):
+        while not self.__stopEvent.wait(max(0.0, nextRead - self.__clock.Now())):
+            nextRead += self.__samplingPeriod
+            self.__Sample()
 
 
 class ThermocoupleFactory(object):
@@ -25,21 +210,10 @@ class ThermocoupleFactory(object):
         pass
 
     def GetInstance(self, Type, kwargs):
-        types = self.ListTypes()
-        if types.__contains__(Type):
-            module = __import__(__name__)
-            _class = getattr(module, Type)
-            return _class(kwargs)
-        else:
-            raise Exception("Unsupported thermocouple type")
+        return THERMOCOUPLES.GetInstance(Type, kwargs)
 
     def ListTypes(self):
-        types = list()
-        for _class in Thermocouple.__subclasses__():
-            classInfo = str(_class).split('.')
-            strippedClass = classInfo[1].strip('\'>')
-            types.append(strippedClass)
-        return types
+        return THERMOCOUPLES.ListTypes()
 
 
 if __name__ == '__main__':